@@ -0,0 +1,454 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+from organize import OrganizerEngine, HistoryJournal, DEFAULT_CATEGORIES, setup_logging
+
+# Extension mixes for the synthetic folders. 'default' spreads files evenly
+# over every known extension plus some the organizer doesn't recognize.
+MIXES = {
+    'default': [ext for exts in DEFAULT_CATEGORIES.values() for ext in exts] + ['.dat', '.bin', ''],
+    'photos': ['.jpg'] * 6 + ['.png', '.mp4', '.mov', '.heic'],
+    'downloads': ['.pdf', '.zip', '.exe', '.docx', '.jpg', '.mp3', '.tar.gz', '.iso', ''],
+    'unknown': ['', '.dat', '.bin', '.tmp', '.part'],
+}
+
+PHASES = ['scan', 'classify', 'organize', 'undo', 'save_state']
+
+# Run in a fresh interpreter to time a cold start: importing the module,
+# then getting the engine ready (settings only), then reading the history
+STARTUP_SCRIPT = '''
+import sys, json, time
+start = time.perf_counter()
+import organize
+imported = time.perf_counter()
+engine = organize.OrganizerEngine(state_file=sys.argv[1], history_file=sys.argv[2],
+                                  cache_file=sys.argv[3], wal_file=sys.argv[4])
+engine.load_state()
+ready = time.perf_counter()
+engine.load_history()
+loaded = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'ready_ms': (ready - start) * 1000,
+    'history_ms': (loaded - ready) * 1000,
+    'runs': len(engine.move_history),
+    'gui_modules': [name for name in ('tkinter', 'schedule') if name in sys.modules]
+}))
+'''
+
+
+def parse_mix(text):
+    # Either a named mix or "jpg=50,pdf=30,bin=20"
+    if text in MIXES:
+        return MIXES[text]
+    mix = []
+    for part in text.split(','):
+        ext, _, weight = part.partition('=')
+        ext = ext.strip()
+        if ext and not ext.startswith('.'):
+            ext = '.' + ext
+        mix += [ext] * int(weight or 1)
+    return mix
+
+
+def parse_size(text):
+    # A fixed size in bytes ("4096") or a range ("0-65536")
+    low, _, high = text.partition('-')
+    return int(low), int(high or low)
+
+
+def generate_tree(path, count, mix, sizes, seed=0):
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    low, high = sizes
+    filler = b'\0' * high
+
+    for i in range(count):
+        name = f"file{i:07d}_{rng.getrandbits(32):08x}{rng.choice(mix)}"
+        size = rng.randint(low, high)
+        with open(os.path.join(path, name), 'wb') as f:
+            if size:
+                # A unique prefix keeps the files from being duplicates
+                f.write(i.to_bytes(8, 'little')[:size] + filler[:max(0, size - 8)])
+
+
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KiB on Linux
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+class SyscallCounter:
+    # Counts the system calls made while a phase runs. With strace on the
+    # PATH (unless --no-strace) it attaches to this process for an exact
+    # count. Otherwise it falls back to Python audit events for file
+    # operations plus the read/write call counts in /proc/self/io, which
+    # misses stat, getdents and fsync calls, so that count is only reported
+    # as approximate and never as syscalls. strace slows the process down a
+    # lot, so counting is done in a pass of its own that isn't timed.
+    audit_events = 0
+    audit_installed = False
+
+    def __init__(self, use_strace):
+        self.use_strace = use_strace and shutil.which('strace') is not None
+        self.exact = self.use_strace
+        self.source = 'strace'
+        if not self.use_strace:
+            self.approximate()
+
+    # Falls back to the approximate count, for good: an audit hook can't be
+    # removed again
+    def approximate(self):
+        self.use_strace = self.exact = False
+        self.source = 'audit+proc-io (approximate)'
+        if not SyscallCounter.audit_installed:
+            sys.addaudithook(SyscallCounter.audit_hook)
+            SyscallCounter.audit_installed = True
+
+    @staticmethod
+    def audit_hook(event, args):
+        if event.startswith(('os.', 'shutil.')) or event == 'open':
+            SyscallCounter.audit_events += 1
+
+    @staticmethod
+    def proc_io_calls():
+        try:
+            with open('/proc/self/io') as f:
+                fields = dict(line.split(': ') for line in f.read().splitlines())
+            return int(fields['syscr']) + int(fields['syscw'])
+        except (OSError, KeyError, ValueError):
+            return 0
+
+    def start(self):
+        if self.use_strace:
+            with tempfile.NamedTemporaryFile(suffix='.strace', delete=False) as f:
+                self.output = f.name
+            self.proc = subprocess.Popen(
+                ['strace', '-f', '-c', '-o', self.output, '-p', str(os.getpid())],
+                stderr=subprocess.PIPE, text=True
+            )
+            # strace reports on stderr once it has attached, or why it
+            # couldn't (e.g. Yama's ptrace_scope keeps it from tracing its
+            # parent)
+            line = self.proc.stderr.readline()
+            if 'attached' in line and self.proc.poll() is None:
+                # It reports every thread it attaches to after that, which
+                # mustn't fill up the pipe
+                threading.Thread(target=self.proc.stderr.read, daemon=True).start()
+                return
+            self.proc.wait()
+            os.remove(self.output)
+            print(f"strace could not attach ({line.strip() or f'exit code {self.proc.returncode}'}), "
+                  f"counting system calls approximately", file=sys.stderr)
+            self.approximate()
+        self.before = SyscallCounter.audit_events + self.proc_io_calls()
+
+    def stop(self):
+        if not self.use_strace:
+            return SyscallCounter.audit_events + self.proc_io_calls() - self.before
+
+        self.proc.send_signal(signal.SIGINT)
+        self.proc.wait()
+        calls = 0
+        with open(self.output) as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[-1] == 'total':
+                    calls = int(fields[3])
+        os.remove(self.output)
+        return calls
+
+
+# Times work(), or with a counter only counts its system calls
+def timed(counter, files, work):
+    if counter is None:
+        start = time.perf_counter()
+        work()
+        elapsed = time.perf_counter() - start
+        return {
+            'seconds': round(elapsed, 6),
+            'files_per_sec': round(files / elapsed, 1) if elapsed else None
+        }
+
+    counter.start()
+    work()
+    calls = counter.stop()
+    per_file = round(calls / files, 2) if files else None
+    return {
+        'syscalls_per_file': per_file if counter.exact else None,
+        'approx_calls_per_file': None if counter.exact else per_file
+    }
+
+
+def calls_text(r):
+    if r['syscalls_per_file'] is not None:
+        return f"{r['syscalls_per_file']:>7.2f} syscalls/file"
+    if r['approx_calls_per_file'] is not None:
+        return f"~{r['approx_calls_per_file']:>6.2f} calls/file (approx.)"
+    return f"{'n/a':>7} syscalls/file"
+
+
+def run_size(root, count, mix, sizes, args, counter=None):
+    work_dir = os.path.join(root, f"bench_{count}")
+    source = os.path.join(work_dir, 'source')
+    shutil.rmtree(work_dir, ignore_errors=True)
+    generate_tree(source, count, mix, sizes, args.seed)
+
+    engine = OrganizerEngine(
+        state_file=os.path.join(work_dir, 'state.json'),
+        rules_file=os.path.join(work_dir, 'rules.json'),
+        history_file=os.path.join(work_dir, 'history.jsonl'),
+        cache_file=os.path.join(work_dir, 'cache.db'),
+        wal_file=os.path.join(work_dir, 'wal.jsonl')
+    )
+    engine.settings['move_workers'] = args.workers
+    engine.settings['sniff'] = args.sniff
+    engine.settings['dedupe'] = args.dedupe
+    engine.settings['log_detail'] = args.log_detail
+
+    results = {}
+    entries = []
+    results['scan'] = timed(counter, count, lambda: entries.extend(engine.scan(source)))
+    results['classify'] = timed(counter, count, lambda: [engine.classify(entry) for entry in entries])
+    del entries[:]
+    results['organize'] = timed(counter, count, lambda: engine.organize(source))
+    results['undo'] = timed(counter, count, engine.undo_last)
+
+    # Saving history used to mean rewriting the whole state file, so time
+    # the settings save together with journaling one run of this size
+    run = {
+        'timestamp': datetime.now().isoformat(),
+        'source': source,
+        'operations': [{'filename': f"file{i}", 'source': source,
+                        'destination': os.path.join(source, 'Others'),
+                        'timestamp': datetime.now().isoformat()} for i in range(count)],
+        'total_moved': count,
+        'total_files': count
+    }
+
+    def save():
+        engine.journal.append(run)
+        engine.journal.sync(force=True)
+        engine.save_state()
+
+    results['save_state'] = timed(counter, count, save)
+    engine.close()
+
+    if not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def write_history(path, runs, files_per_run):
+    journal = HistoryJournal(path, max_runs=None)
+    now = datetime.now().isoformat()
+    for r in range(runs):
+        journal.append({
+            'timestamp': now,
+            'source': '/bench',
+            'operations': [{'filename': f"file{i}.jpg", 'source': '/bench', 'destination': '/bench/Images',
+                            'timestamp': now} for i in range(files_per_run)],
+            'total_moved': files_per_run,
+            'total_files': files_per_run
+        })
+    journal.close()
+
+
+# Cold start times (the best of `repeat` fresh interpreters) with an empty
+# history and with one of history_runs runs
+def startup_times(root, history_runs, repeat):
+    work_dir = os.path.join(root, 'startup')
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+
+    results = {}
+    for runs in (0, history_runs):
+        history_file = os.path.join(work_dir, f"history_{runs}.jsonl")
+        write_history(history_file, runs, 1000)
+        samples = []
+        for _ in range(repeat):
+            output = subprocess.run(
+                [sys.executable, '-c', STARTUP_SCRIPT, os.path.join(work_dir, 'state.json'), history_file,
+                 os.path.join(work_dir, 'cache.db'), os.path.join(work_dir, 'wal.jsonl')],
+                cwd=work_dir, env=env, capture_output=True, text=True, check=True
+            ).stdout
+            samples.append(json.loads(output))
+        best = min(samples, key=lambda sample: sample['ready_ms'])
+        results[str(runs)] = {key: round(value, 2) if isinstance(value, float) else value
+                              for key, value in best.items()}
+
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+# Problems with the startup numbers: over a budget, the GUI modules loaded
+# for a headless start, or startup growing with the history
+def check_startup(startup, args):
+    problems = []
+    empty, full = startup['0'], startup[str(args.history_runs)]
+    if full['import_ms'] > args.import_budget:
+        problems.append(f"import took {full['import_ms']:.0f} ms, budget {args.import_budget:.0f} ms")
+    if full['ready_ms'] > args.startup_budget:
+        problems.append(f"startup took {full['ready_ms']:.0f} ms, budget {args.startup_budget:.0f} ms")
+    if full['gui_modules']:
+        problems.append(f"startup imported {', '.join(full['gui_modules'])}")
+    # The history can only slow down what comes after the import, so leave
+    # out the import's own noise. A few milliseconds of slack for timer
+    # noise on fast starts.
+    empty_setup, full_setup = empty['ready_ms'] - empty['import_ms'], full['ready_ms'] - full['import_ms']
+    if full_setup > empty_setup * (1 + args.tolerance) + 5:
+        problems.append(f"engine setup with {args.history_runs} runs of history took {full_setup:.0f} ms, "
+                        f"{empty_setup:.0f} ms without")
+    return problems
+
+
+# Returns a list of (size, phase, baseline rate, current rate) that got
+# slower than the tolerance allows. Only throughput is compared: system call
+# counts depend on whether strace was there to count them.
+def compare(results, baseline, tolerance):
+    regressions = []
+    for size, phases in results['sizes'].items():
+        for phase, current in phases.items():
+            old = baseline.get('sizes', {}).get(size, {}).get(phase)
+            if not old or not old.get('files_per_sec') or not current.get('files_per_sec'):
+                continue
+            if current['files_per_sec'] < old['files_per_sec'] * (1 - tolerance):
+                regressions.append((size, phase, old['files_per_sec'], current['files_per_sec']))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the file organizer on synthetic folders")
+    parser.add_argument('--sizes', default='1000,10000',
+                        help="comma separated file counts to test (default: %(default)s)")
+    parser.add_argument('--mix', default='default',
+                        help=f"extension mix: {', '.join(MIXES)} or e.g. jpg=50,pdf=30,bin=20")
+    parser.add_argument('--file-size', default='0',
+                        help="file size in bytes, or a range like 0-65536 (default: %(default)s)")
+    parser.add_argument('--root', help="folder to build the trees in (default: a temp folder)")
+    parser.add_argument('--tmpfs', action='store_true',
+                        help="build the trees in /dev/shm instead of the default temp folder")
+    parser.add_argument('--workers', type=int, default=4, help="move_workers setting")
+    parser.add_argument('--sniff', default='off', choices=['off', 'fill', 'override'])
+    parser.add_argument('--dedupe', default='off', choices=['off', 'report', 'move'])
+    parser.add_argument('--log-detail', default='files', choices=['files', 'summary'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-strace', action='store_true',
+                        help="don't attach strace even if it is installed; system calls are then "
+                             "only approximated")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed slowdown against the baseline (default: %(default)s)")
+    parser.add_argument('--keep', action='store_true', help="keep the generated trees")
+    parser.add_argument('--history-runs', type=int, default=500,
+                        help="runs of history (1000 files each) for the startup check (default: %(default)s)")
+    parser.add_argument('--startup-repeat', type=int, default=5,
+                        help="cold starts to take the best of (default: %(default)s, 0 skips the check)")
+    parser.add_argument('--import-budget', type=float, default=150,
+                        help="allowed time to import the module, in ms (default: %(default)s)")
+    parser.add_argument('--startup-budget', type=float, default=250,
+                        help="allowed time until the engine is ready, in ms (default: %(default)s)")
+    parser.add_argument('--startup-only', action='store_true',
+                        help="only run the startup check and skip the folder sizes, e.g. as a test")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    if args.startup_only:
+        sizes = []
+        args.startup_repeat = args.startup_repeat or 1
+    mix = parse_mix(args.mix)
+    file_sizes = parse_size(args.file_size)
+
+    if args.root:
+        root = args.root
+        os.makedirs(root, exist_ok=True)
+    else:
+        root = tempfile.mkdtemp(prefix='organizer_bench_', dir='/dev/shm' if args.tmpfs else None)
+
+    # The engine logs every move, which is part of what is being measured
+    log_writer = setup_logging(os.path.join(root, 'bench_log.jsonl'))
+
+    results = {
+        'timestamp': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'root': root,
+        'mix': args.mix,
+        'file_size': args.file_size,
+        'workers': args.workers,
+        'sizes': {}
+    }
+
+    try:
+        if args.startup_repeat:
+            startup = results['startup'] = startup_times(root, args.history_runs, args.startup_repeat)
+            for runs, r in startup.items():
+                print(f"startup with {runs} runs of history: import {r['import_ms']:.1f} ms, "
+                      f"ready {r['ready_ms']:.1f} ms, history loaded in {r['history_ms']:.1f} ms")
+
+        # Every size is timed before anything is counted, so neither strace
+        # nor the fallback's audit hook slows down the timed runs
+        for count in sizes:
+            results['sizes'][str(count)] = run_size(root, count, mix, file_sizes, args)
+        # ru_maxrss only ever grows, so it is one number for all the runs
+        results['peak_rss_kb'] = peak_rss_kb()
+
+        if sizes:
+            counter = SyscallCounter(not args.no_strace)
+            for count in sizes:
+                for phase, calls in run_size(root, count, mix, file_sizes, args, counter).items():
+                    results['sizes'][str(count)][phase].update(calls)
+            results['syscall_source'] = counter.source
+
+        for count in sizes:
+            print(f"{count} files:")
+            for phase in PHASES:
+                r = results['sizes'][str(count)][phase]
+                print(f"  {phase:<10} {r['seconds']:>9.3f}s {r['files_per_sec'] or 0:>12.0f} files/s "
+                      f"{calls_text(r)}")
+        if sizes:
+            print(f"peak memory {results['peak_rss_kb']} KiB, system calls counted with {results['syscall_source']}")
+    finally:
+        log_writer.stop()
+        if not args.root and not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = False
+    if args.startup_repeat:
+        for problem in check_startup(results['startup'], args):
+            print(f"STARTUP: {problem}")
+            failed = True
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for size, phase, old, new in regressions:
+            print(f"REGRESSION: {phase} at {size} files: {new:.0f} files/s, baseline {old:.0f}")
+        if regressions:
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
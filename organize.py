@@ -1,27 +1,3435 @@
 import os
+import re
+import sys
+import errno
+import importlib
+import select
+import struct
 import shutil
+import atexit
 import logging
-import schedule
+import logging.handlers
+import argparse
 import time
 import threading
+import queue
 import json
-from datetime import datetime
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk, scrolledtext
+import bisect
+import collections
+import copy
+import fnmatch
+import hashlib
+import sqlite3
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from stat import S_IMODE, S_ISLNK, S_ISREG
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Only the GUI needs tkinter, only the scheduler needs schedule and only the
+# inotify watcher needs ctypes, so they are imported by lazy_import when
+# first used and headless runs never load them
+tk = filedialog = messagebox = ttk = scrolledtext = None
+schedule = None
+ctypes = None
+
+# Define file categories and their extensions
+DEFAULT_CATEGORIES = {
+    'Images': ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.svg', '.webp'],
+    'Videos': ['.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.webm', '.m4v'],
+    'Documents': ['.pdf', '.docx', '.doc', '.txt', '.xlsx', '.pptx', '.csv', '.rtf', '.odt'],
+    'Music': ['.mp3', '.wav', '.flac', '.aac', '.ogg', '.wma', '.m4a'],
+    'Archives': ['.zip', '.rar', '.7z', '.tar', '.gz', '.bz2'],
+    'Code': ['.py', '.js', '.html', '.css', '.java', '.cpp', '.c', '.php', '.rb', '.json', '.xml'],
+    'Executables': ['.exe', '.msi', '.bat', '.sh', '.deb', '.rpm'],
+    'Others': []  # For any other file types
+}
+
+# Settings saved in the state file, with their defaults. History lives in
+# its own journal file.
+DEFAULT_SETTINGS = {
+    'source_path': '',
+    'schedule_minutes': 5,
+    'move_workers': 4,
+    'watch_mode': False,
+    'dedupe': 'off',  # 'off', 'report' or 'move' (to the Duplicates folder)
+    'sniff': 'fill',  # 'off', 'fill' (only unknown extensions) or 'override'
+    'metrics_file': None,  # Prometheus textfile written after every run
+    # What to do when a category folder already has a file of the same name:
+    # 'skip', 'rename' (add a counter), 'rename-hash' (add part of the
+    # content hash), 'overwrite-newer' or 'dedupe' (identical files go to
+    # Duplicates, others are renamed)
+    'conflicts': 'rename',
+    # Runs found cut short at startup: 'ask' (the GUI asks, headless runs
+    # resume), 'resume' or 'rollback'
+    'recovery': 'ask',
+    # 'files' logs every move, 'summary' one line per run with the number
+    # of files moved into each category (errors are always logged)
+    'log_detail': 'files',
+    # Organize the files in subfolders too (into the category folders at
+    # the top). Folders matching an exclude pattern are skipped; with
+    # include patterns only matching folders are organized.
+    'recursive': False,
+    'include_dirs': [],
+    'exclude_dirs': [],
+    'scan_workers': 8,
+    # Limits for runs, to keep out of the way of other work on the machine:
+    # moves and bytes copied per second (None for no limit; a folder in
+    # 'folders' can set its own under "limits"), pausing while the disk
+    # pressure in /proc/pressure/io is above max_io_pressure percent, and
+    # running at a lower CPU priority (nice) and I/O priority ('low' or
+    # 'idle')
+    'max_moves_per_sec': None,
+    'max_bytes_per_sec': None,
+    'max_io_pressure': None,
+    'nice': None,
+    'io_priority': None,
+    # Leave files alone until their size and mtime have stayed the same for
+    # this many seconds (0 moves everything), and optionally while any
+    # process has them open for writing
+    'quiet_seconds': 0,
+    'check_open_files': False,
+    # Check copies to another filesystem against a hash taken while copying
+    # before removing the source
+    'verify_copies': False,
+    # More scheduled folders besides source_path, each like
+    # {"path": "...", "minutes": 5, "rules_file": "inbox_rules.json",
+    #  "limits": {"max_bytes_per_sec": 10485760}}
+    'folders': [],
+    'scheduler_workers': 4,
+    'max_backoff': 8,
+    'history_max_runs': 1000,
+    'history_max_days': None
+}
+
+LOG_FILE = 'organizer_log.jsonl'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 3
+# The Logs tab shows the newest LOG_VIEW_LINES lines and pages through
+# older ones LOG_PAGE_LINES at a time
+LOG_VIEW_LINES = 2000
+LOG_PAGE_LINES = 500
+HISTORY_PAGE = 50
+STATE_FILE = 'organizer_state.json'
+HISTORY_FILE = 'organizer_history.jsonl'
+CACHE_FILE = 'organizer_cache.db'
+WAL_FILE = 'organizer_wal.jsonl'
+
+# Files classified together when content sniffing is on
+SNIFF_BATCH = 256
+# Files a recursive scan worker classifies and hands on together
+SCAN_BATCH = 256
+WAL_BATCH = 256  # moves made durable in the write-ahead log with one fsync
+RULES_FILE = 'organizer_rules.json'
+
+# ioprio_set system call numbers by machine, and its constants
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273,
+              's390x': 282, 'riscv64': 30}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+
+# How often the UI redraws progress from a background run (about 20 fps)
+UI_REFRESH_MS = 50
+
+
+class LogWriter:
+    # Writes log records as JSON Lines on a background thread. Logging calls
+    # only put the record on a queue (through a QueueHandler); the writer
+    # wakes at most every `interval` seconds and writes everything that has
+    # piled up with one write call, so a burst of per-file messages costs
+    # one syscall per batch instead of one per line and the writer isn't
+    # woken (and fighting the mover for the GIL) for every record. The file
+    # is rotated by size like RotatingFileHandler. Structured fields passed
+    # as extra={'fields': {...}} become keys of the line.
+    def __init__(self, path=LOG_FILE, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, interval=0.1):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.interval = interval
+        self.queue = queue.SimpleQueue()
+        self.file = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, name='log-writer', daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            if batch[0] is not None and not isinstance(batch[0], threading.Event):
+                time.sleep(self.interval)
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            waiters = []
+            for item in batch:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    lines.append(self.format(item))
+
+            if lines:
+                try:
+                    self.write(''.join(lines))
+                except OSError as e:
+                    print(f"Error writing log: {str(e)}", file=sys.stderr)
+            for waiter in waiters:
+                waiter.set()
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    @staticmethod
+    def format(record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(sep=' ', timespec='milliseconds'),
+            'level': record.levelname,
+            'msg': record.getMessage()
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        return json.dumps(entry, separators=(',', ':'), default=str) + '\n'
+
+    def write(self, text):
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.file.write(text)
+        self.file.flush()
+        # fstat rather than counting, so a log cleared from the GUI is noticed
+        if self.max_bytes and os.fstat(self.file.fileno()).st_size >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        if self.backups:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            open(self.path, 'w').close()
+
+    # Waits until everything logged so far is in the file
+    def flush(self, timeout=2.0):
+        if self.thread is not None and self.thread.is_alive():
+            done = threading.Event()
+            self.queue.put(done)
+            done.wait(timeout)
+
+    def stop(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # The messages here are already formatted f-strings, so the copy and
+    # re-format QueueHandler.prepare does for every record can be skipped
+    def prepare(self, record):
+        if record.args or record.exc_info:
+            return super().prepare(record)
+        return record
+
+
+log_writer = None
+
+
+# lazy_import(tk='tkinter') imports the module the first time and binds it
+# to that global name, which the code using it then reads as usual
+def lazy_import(**modules):
+    for name, module in modules.items():
+        if globals()[name] is None:
+            globals()[name] = importlib.import_module(module)
+
+
+def setup_logging(path=LOG_FILE):
+    global log_writer
+    log_writer = LogWriter(path)
+    log_writer.start()
+    atexit.register(log_writer.stop)
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(LogQueueHandler(log_writer.queue))
+    return log_writer
+
+
+def flush_logs():
+    if log_writer is not None:
+        log_writer.flush()
+
+
+# One log line as text for the Logs tab; lines from before the log was JSON
+# are shown as they are
+def format_log_line(line):
+    try:
+        entry = json.loads(line)
+        return f"{entry['time'][:19]} - {entry['msg']}\n"
+    except (ValueError, KeyError, TypeError):
+        return line if line.endswith('\n') else line + '\n'
+
+
+class LogTail:
+    # Follows the log file for the Logs tab. Only bytes appended since the
+    # last read are read, the newest max_lines lines are kept in a ring
+    # buffer, and the byte offset of every page_lines-th line is indexed so
+    # older pages and searches can seek straight to them instead of
+    # loading the file. A new inode means the log was rotated and a size
+    # below the read offset means it was cleared; both start over.
+    def __init__(self, path=LOG_FILE, max_lines=LOG_VIEW_LINES, page_lines=LOG_PAGE_LINES):
+        self.path = path
+        self.max_lines = max_lines
+        self.page_lines = page_lines
+        self.lines = collections.deque(maxlen=max_lines)
+        self.reset()
+
+    def reset(self):
+        self.inode = None
+        self.offset = 0
+        self.partial = b''
+        self.pages = []
+        self.line_count = 0
+        self.lines.clear()
+
+    # Returns (reset, new lines). reset is True when the earlier lines are
+    # gone and self.lines holds everything there is to show.
+    def read_new(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            was_open = self.inode is not None
+            self.reset()
+            return was_open, []
+
+        reset = False
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            self.reset()
+            self.inode = st.st_ino
+            reset = True
+        if st.st_size == self.offset:
+            return reset, []
+
+        recent = collections.deque(maxlen=self.max_lines)
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                # Offset in the file where `data` starts
+                base = self.offset - len(self.partial)
+                data = self.partial + chunk
+                self.offset += len(chunk)
+                end = data.rfind(b'\n') + 1
+                self.partial = data[end:]
+
+                pos = 0
+                for line in data[:end].splitlines(keepends=True):
+                    if self.line_count % self.page_lines == 0:
+                        self.pages.append(base + pos)
+                    self.line_count += 1
+                    pos += len(line)
+                    recent.append(line)
+
+        new = [format_log_line(line.decode('utf-8', 'replace')) for line in recent]
+        self.lines.extend(new)
+        return reset, new
+
+    # Lines [page * page_lines, (page + 1) * page_lines) of the file
+    def read_page(self, page):
+        start = self.pages[page]
+        end = self.pages[page + 1] if page + 1 < len(self.pages) else self.offset - len(self.partial)
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+        return [format_log_line(line.decode('utf-8', 'replace')) for line in data.splitlines(keepends=True)]
+
+    # The newest `limit` lines containing `text` (case-insensitive), oldest
+    # first, reading the file a page at a time from the end
+    def search(self, text, limit=LOG_VIEW_LINES):
+        text = text.lower()
+        matches = []
+        for page in range(len(self.pages) - 1, -1, -1):
+            found = [line for line in self.read_page(page) if text in line.lower()]
+            matches[:0] = found
+            if len(matches) >= limit:
+                return matches[-limit:]
+        return matches
+
+
+class RuleTable:
+    # The categories compiled into lookup tables, so classifying a file is a
+    # dict hit instead of a walk over every category's extension list.
+    #
+    # The rules file is optional JSON of the form:
+    #   {"categories": {"Archives": [".tar.gz", ".tgz"], "Ebooks": [".epub"]},
+    #    "rules": [{"category": "Screenshots", "glob": "Screenshot*.png"},
+    #              {"category": "Invoices", "regex": "^INV-\\d+"},
+    #              {"category": "Large", "min_size": 1073741824},
+    #              {"category": "Old", "older_than_days": 365}]}
+    # Extra categories are merged into the defaults. Rules are checked in
+    # order before the extension lookup, and every condition in a rule must
+    # match for it to apply.
+    def __init__(self, categories, rules_file=RULES_FILE):
+        self.base_categories = categories
+        self.rules_file = rules_file
+        self.rules_mtime = None
+        self.compile(categories, [])
+        self.refresh()
+
+    def refresh(self):
+        # Rebuild only when the rules file has changed since the last load
+        try:
+            mtime = os.stat(self.rules_file).st_mtime_ns
+        except OSError:
+            mtime = None
+
+        if mtime == self.rules_mtime:
+            return False
+
+        self.rules_mtime = mtime
+        if mtime is None:
+            self.compile(self.base_categories, [])
+            return True
+
+        try:
+            with open(self.rules_file, 'r') as f:
+                config = json.load(f)
+
+            categories = {cat: list(exts) for cat, exts in self.base_categories.items()}
+            for cat, exts in config.get('categories', {}).items():
+                merged = categories.setdefault(cat, [])
+                merged.extend(ext.lower() for ext in exts if ext.lower() not in merged)
+
+            self.compile(categories, config.get('rules', []))
+            logging.info(f"Loaded rules from {self.rules_file}")
+
+        except Exception as e:
+            logging.error(f"Error loading rules from {self.rules_file}: {str(e)}")
+
+        return True
+
+    def compile(self, categories, rules):
+        ext_map = {}
+        suffix_trie = {}
+
+        for cat, exts in categories.items():
+            for ext in exts:
+                ext = ext.lower()
+                if ext.count('.') > 1:
+                    # Multi-part extensions like .tar.gz go into a trie keyed
+                    # on the name's dotted parts, read from the end
+                    node = suffix_trie
+                    for part in reversed(ext.split('.')[1:]):
+                        node = node.setdefault(part, {})
+                    node.setdefault(None, cat)
+                else:
+                    # The first category listing an extension wins
+                    ext_map.setdefault(ext, cat)
+
+        compiled_rules = []
+        for rule in rules:
+            checks = []
+            if 'glob' in rule:
+                checks.append(('name', re.compile(fnmatch.translate(rule['glob']), re.IGNORECASE).match))
+            if 'regex' in rule:
+                checks.append(('name', re.compile(rule['regex']).search))
+            if 'min_size' in rule:
+                min_size = rule['min_size']
+                checks.append(('stat', lambda st, n=min_size: st.st_size >= n))
+            if 'max_size' in rule:
+                max_size = rule['max_size']
+                checks.append(('stat', lambda st, n=max_size: st.st_size <= n))
+            if 'older_than_days' in rule:
+                age = rule['older_than_days'] * 86400
+                checks.append(('stat', lambda st, a=age: time.time() - st.st_mtime >= a))
+            if 'newer_than_days' in rule:
+                age = rule['newer_than_days'] * 86400
+                checks.append(('stat', lambda st, a=age: time.time() - st.st_mtime < a))
+
+            if checks:
+                needs_stat = any(kind == 'stat' for kind, _ in checks)
+                compiled_rules.append((rule['category'], checks, needs_stat))
+
+        # Swap everything in at once so a concurrent classify never sees a
+        # half-built table
+        self.categories = categories
+        self.ext_map = ext_map
+        self.suffix_trie = suffix_trie
+        self.rules = compiled_rules
+
+    # stat is an optional callable (such as DirEntry.stat) that is only
+    # called when a size or age rule needs it
+    def classify(self, filename, stat=None):
+        category = self.match_rules(filename, stat)
+        if category is None:
+            category = self.match_extension(filename)
+        return category
+
+    def match_rules(self, filename, stat=None):
+        if self.rules:
+            st = None
+            for category, checks, needs_stat in self.rules:
+                if needs_stat and st is None:
+                    if stat is None:
+                        continue
+                    try:
+                        st = stat()
+                    except OSError:
+                        continue
+                if all(check(filename if kind == 'name' else st) for kind, check in checks):
+                    return category
+        return None
+
+    def match_extension(self, filename):
+        name = filename.lower()
+
+        if self.suffix_trie and name.count('.') > 1:
+            parts = name.split('.')
+            node = self.suffix_trie
+            category = None
+            # parts[0] is the stem, so stop before it
+            for part in reversed(parts[1:]):
+                node = node.get(part)
+                if node is None:
+                    break
+                category = node.get(None, category)
+            if category:
+                return category
+
+        _, ext = os.path.splitext(name)
+        return self.ext_map.get(ext, 'Others')
+
+
+class RunMetrics:
+    # Timers and counters for organize runs. Phase times are the time spent
+    # in each stage summed over all threads, so with parallel copies they
+    # can add up to more than the run's wall time.
+    PHASES = ('scan', 'classify', 'dedupe', 'mkdir', 'move', 'log', 'save_state')
+    COUNTERS = ('runs', 'files_scanned', 'files_moved', 'renames', 'cross_device_copies', 'bytes_copied',
+                'conflicts', 'reflinks')
+    LATENCY_BUCKETS = (0.001, 0.005, 0.025, 0.1, 0.5, 2.5, 10, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.wall_seconds = 0.0
+        self.finished_at = None
+        self.phase_seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.errors = {}
+        self.latency_counts = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.phase_seconds[phase] += seconds
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    # Wrap a generator so the time spent producing each item is counted
+    def timed_iter(self, phase, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(phase, time.perf_counter() - start)
+                return
+            self.add_time(phase, time.perf_counter() - start)
+            yield item
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def error(self, error):
+        name = type(error).__name__
+        with self.lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def observe_move(self, seconds, copied_bytes=None):
+        with self.lock:
+            self.phase_seconds['move'] += seconds
+            self.latency_sum += seconds
+            self.latency_counts[bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+            if copied_bytes is None:
+                self.counters['renames'] += 1
+            else:
+                self.counters['cross_device_copies'] += 1
+                self.counters['bytes_copied'] += copied_bytes
+
+    def finish(self):
+        self.wall_seconds = time.monotonic() - self.started
+        self.finished_at = time.time()
+        self.counters['runs'] = 1
+
+    # Add another run's numbers into this one (used for process totals)
+    def merge(self, other):
+        with self.lock:
+            for phase, seconds in other.phase_seconds.items():
+                self.phase_seconds[phase] += seconds
+            for name, value in other.counters.items():
+                self.counters[name] += value
+            for name, value in other.errors.items():
+                self.errors[name] = self.errors.get(name, 0) + value
+            for i, value in enumerate(other.latency_counts):
+                self.latency_counts[i] += value
+            self.latency_sum += other.latency_sum
+            self.wall_seconds += other.wall_seconds
+            self.finished_at = other.finished_at
+
+    # Short form kept with each run in the history
+    def summary(self):
+        return {
+            'seconds': round(time.monotonic() - self.started, 3),
+            'phases': {phase: round(seconds, 4) for phase, seconds in self.phase_seconds.items() if seconds},
+            'files_scanned': self.counters['files_scanned'],
+            'cross_device_copies': self.counters['cross_device_copies'],
+            'bytes_copied': self.counters['bytes_copied'],
+            'errors': dict(self.errors)
+        }
+
+    # Prometheus text exposition format, for the node_exporter textfile
+    # collector
+    def prometheus(self, prefix='organizer'):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{prefix}_{name}{labels} {value}")
+
+        with self.lock:
+            for name in self.COUNTERS:
+                metric(f"{name}_total", 'counter', f"Total {name.replace('_', ' ')}",
+                       [('', self.counters[name])])
+            metric('phase_seconds_total', 'counter', "Time spent in each stage of organize runs",
+                   [(f'{{phase="{phase}"}}', round(seconds, 6)) for phase, seconds in self.phase_seconds.items()])
+            metric('errors_total', 'counter', "Failed moves by error type",
+                   [(f'{{type="{name}"}}', value) for name, value in sorted(self.errors.items())])
+
+            buckets = []
+            cumulative = 0
+            for bound, value in zip(self.LATENCY_BUCKETS + ('+Inf',), self.latency_counts):
+                cumulative += value
+                buckets.append((f'{{le="{bound}"}}', cumulative))
+            metric('move_latency_seconds', 'histogram', "Time taken by each move", [])
+            lines += [f"{prefix}_move_latency_seconds_bucket{labels} {value}" for labels, value in buckets]
+            lines.append(f"{prefix}_move_latency_seconds_sum {round(self.latency_sum, 6)}")
+            lines.append(f"{prefix}_move_latency_seconds_count {cumulative}")
+
+            if self.finished_at:
+                metric('last_run_timestamp_seconds', 'gauge', "When the last run finished",
+                       [('', round(self.finished_at, 3))])
+        return '\n'.join(lines) + '\n'
+
+
+# One line summing up a run's metrics, for the history list and the CLI
+def describe_metrics(summary):
+    text = f"{summary['seconds']:.1f}s"
+    if summary['phases']:
+        slowest = max(summary['phases'], key=summary['phases'].get)
+        text += f", slowest stage: {slowest}"
+    if summary['cross_device_copies']:
+        text += f", {summary['cross_device_copies']} copies ({summary['bytes_copied'] / 1048576:.1f} MB)"
+    errors = sum(summary['errors'].values())
+    if errors:
+        text += f", {errors} errors"
+    return text
+
+
+# Splits "archive.tar.gz" into ("archive", ".tar.gz") so suffixes are added
+# before the whole extension
+def split_name(filename):
+    stem, ext = os.path.splitext(filename)
+    if stem.lower().endswith('.tar'):
+        stem, ext = stem[:-4], stem[-4:] + ext
+    return stem, ext
+
+
+# "photo.jpg" becomes "photo (1).jpg", "photo (2).jpg" and so on until the
+# name isn't in `names`
+def unique_name(filename, names):
+    stem, ext = split_name(filename)
+    counter = names.counters.get(filename, 1)
+    while f"{stem} ({counter}){ext}" in names:
+        counter += 1
+    names.counters[filename] = counter + 1
+    return f"{stem} ({counter}){ext}"
+
+
+class NameSet(set):
+    # The names in a category folder. It also remembers the next counter
+    # unique_name will try for each name, so the thousandth file called
+    # IMG_0001.jpg in a recursive run doesn't try (1) to (999) first.
+    def __init__(self, names=()):
+        super().__init__(names)
+        self.counters = {}
+
+
+# Plans are JSON Lines: a header with the folder and time, then one line
+# per move, so they stream and diff well
+def write_plan(plan, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps({'source': plan['source'], 'created': plan['created']}) + '\n')
+        for move in plan['moves']:
+            f.write(json.dumps(move, separators=(',', ':')) + '\n')
+    os.replace(tmp_path, path)
+
+
+def load_plan(path):
+    with open(path) as f:
+        plan = json.loads(f.readline())
+        plan['moves'] = [json.loads(line) for line in f if line.strip()]
+    return plan
+
+
+# {category: (files, bytes)}
+def summarize_plan(plan):
+    summary = {}
+    for move in plan['moves']:
+        count, size = summary.get(move['category'], (0, 0))
+        summary[move['category']] = (count + 1, size + move['size'])
+    return summary
+
+
+# (where the file is now, where undo puts it back) for an undo record
+def undo_paths(operation):
+    return (os.path.join(operation['destination'], operation.get('target', operation['filename'])),
+            os.path.join(operation['source'], operation['filename']))
+
+
+# The hidden file a cross-device copy is written to before it is renamed
+# into place
+def partial_path(dest):
+    directory, name = os.path.split(dest)
+    return os.path.join(directory, f".{name}.partial")
+
+
+# Builds TreeScanner's select(relative path) for recursive runs. A folder
+# whose name or relative path matches an exclude pattern is pruned, as are
+# the top-level names in `skip` (the category folders). With include
+# patterns, only folders matching one are organized; they are matched a
+# path component at a time, so the folders leading down to a possible
+# match are walked through without taking their files, and nothing else
+# is read at all.
+def dir_filter(include=(), exclude=(), skip=()):
+    include = [pattern.strip('/').split('/') for pattern in include]
+
+    def select(rel):
+        parts = rel.split(os.sep)
+        if len(parts) == 1 and rel in skip:
+            return False, False
+        path = '/'.join(parts)
+        if any(fnmatch.fnmatch(parts[-1], pattern) or fnmatch.fnmatch(path, pattern) for pattern in exclude):
+            return False, False
+        if not include:
+            return True, True
+
+        descend = False
+        for pattern in include:
+            if all(fnmatch.fnmatch(part, p) for part, p in zip(parts, pattern)):
+                if len(parts) >= len(pattern):
+                    return True, True
+                descend = True
+        return descend, False
+    return select
+
+
+# The files under `folder` that some process has open for writing, found
+# through /proc/*/fd, with paths starting with `folder` as given. Only the
+# descriptors that point into the folder have their flags read. Other
+# users' processes can only be seen when running as root.
+def open_for_writing(folder):
+    real = os.path.realpath(folder)
+    prefix = os.path.join(real, '')
+    paths = set()
+    try:
+        pids = [name for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return paths
+
+    for pid in pids:
+        try:
+            fds = os.listdir(f"/proc/{pid}/fd")
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(f"/proc/{pid}/fd/{fd}")
+                if not target.startswith(prefix):
+                    continue
+                with open(f"/proc/{pid}/fdinfo/{fd}") as f:
+                    flags = next(int(line.split()[1], 8) for line in f if line.startswith('flags:'))
+            except (OSError, ValueError, StopIteration):
+                continue
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                paths.add(os.path.join(folder, os.path.relpath(target, real)))
+    return paths
+
+
+# Identifies an undo record within its run
+def undo_key(operation):
+    return operation['destination'], operation.get('target', operation['filename'])
+
+
+def sorted_moves(run):
+    return [move for _, move in sorted(run['moves'].items())]
+
+
+# One move made while recovering an interrupted run
+def recover_move(src, dest, action):
+    try:
+        shutil.move(src, dest)
+        logging.info(f"{action}: moved {os.path.basename(src)} to {os.path.dirname(dest)}")
+        return True
+    except OSError as e:
+        logging.error(f"{action}: could not move {src}: {str(e)}")
+        return False
+
+
+# Compares two plans by source file: what only the new plan moves, what
+# only the old one did, and what goes somewhere else now
+def diff_plans(old, new):
+    old_targets = {move['source']: move['target'] for move in old['moves']}
+    new_targets = {move['source']: move['target'] for move in new['moves']}
+    return {
+        'added': sorted(set(new_targets) - set(old_targets)),
+        'removed': sorted(set(old_targets) - set(new_targets)),
+        'changed': sorted(path for path in set(old_targets) & set(new_targets)
+                          if old_targets[path] != new_targets[path])
+    }
+
+
+# Share of the last 10 seconds in which some task was stalled waiting on
+# disk I/O (Linux pressure stall information), or None where the kernel
+# doesn't report it
+def io_pressure(path='/proc/pressure/io'):
+    try:
+        with open(path) as f:
+            fields = f.readline().split()
+    except OSError:
+        return None
+    for field in fields[1:]:
+        key, _, value = field.partition('=')
+        if key == 'avg10':
+            return float(value)
+    return None
+
+
+# Lowers the calling thread's CPU priority (nice) and I/O priority
+# (ioprio_set: 'low' is the lowest best-effort level, 'idle' only gets the
+# disk when nobody else wants it). On Linux both are per thread and the
+# threads started afterwards (movers, scanners) inherit them, so a run's
+# job thread can be lowered without slowing down the GUI.
+def lower_priority(nice=None, io_priority=None):
+    if nice is not None:
+        try:
+            if os.getpriority(os.PRIO_PROCESS, 0) < nice:
+                os.setpriority(os.PRIO_PROCESS, 0, nice)
+        except (AttributeError, OSError) as e:
+            logging.error(f"Could not lower the CPU priority: {str(e)}")
+
+    number = IOPRIO_SET.get(os.uname().machine) if hasattr(os, 'uname') else None
+    if io_priority is None or not sys.platform.startswith('linux') or number is None:
+        return
+    priority = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT if io_priority == 'idle' \
+        else IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT | 7
+    lazy_import(ctypes='ctypes')
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, priority) < 0:
+        logging.error(f"Could not lower the I/O priority: {os.strerror(ctypes.get_errno())}")
+
+
+class TokenBucket:
+    # Allows `rate` units a second on average, with bursts of up to one
+    # second's worth. A take larger than what is left is granted at once
+    # and the caller sleeps off the debt, so concurrent callers queue up
+    # in order and large copies don't need splitting to fit the bucket.
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, n, cancel=None):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            if cancel is not None:
+                cancel.wait(wait)
+            else:
+                time.sleep(wait)
+
+
+class Throttle:
+    # The limits on one run: moves a second and bytes copied a second, and
+    # pausing while the system's disk pressure is above max_pressure (a
+    # percentage, checked at most once a second). MoveExecutor calls move()
+    # before each move and the copier calls copied() after each chunk.
+    def __init__(self, moves_per_sec=None, bytes_per_sec=None, max_pressure=None, cancel=None):
+        self.moves = TokenBucket(moves_per_sec) if moves_per_sec else None
+        self.bytes = TokenBucket(bytes_per_sec) if bytes_per_sec else None
+        self.max_pressure = max_pressure
+        self.cancel = cancel
+        self.next_check = 0
+        # Copy in pieces of a tenth of a second's worth, so the waits are
+        # short and spread evenly
+        self.chunk_size = max(64 * 1024, int(bytes_per_sec) // 10) if bytes_per_sec else None
+
+    def move(self):
+        if self.max_pressure is not None:
+            self.check_pressure()
+        if self.moves is not None:
+            self.moves.take(1, self.cancel)
+
+    def copied(self, n):
+        if self.bytes is not None:
+            self.bytes.take(n, self.cancel)
+
+    def check_pressure(self):
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+        self.next_check = now + 1
+        pressure = io_pressure()
+        if pressure is None or pressure < self.max_pressure:
+            return
+
+        logging.info(f"Disk pressure is at {pressure:.0f}%, pausing moves")
+        while pressure is not None and pressure >= self.max_pressure:
+            if self.cancel is not None and self.cancel.wait(1):
+                return
+            if self.cancel is None:
+                time.sleep(1)
+            pressure = io_pressure()
+        logging.info("Disk pressure is down, resuming moves")
+        self.next_check = time.monotonic() + 1
+
+
+class FileCopier:
+    # Copies a file to another filesystem for MoveExecutor, using the
+    # cheapest way the two filesystems allow: a reflink clone (FICLONE,
+    # which shares the blocks and copies nothing), then copy_file_range and
+    # sendfile (which copy inside the kernel), and only then read/write
+    # through a large buffer. A way that fails as unsupported is remembered
+    # per pair of devices so later files go straight to the next one. The
+    # copy is written to a hidden partial file, given the source's mode,
+    # times and extended attributes, fsynced and then renamed over the
+    # destination, so the destination never holds half a file.
+    FICLONE = 0x40049409
+    CHUNK_SIZE = 1 << 30  # per copy_file_range/sendfile call
+    BUFFER_SIZE = 8 * 1024 * 1024
+    UNSUPPORTED = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP, errno.EBADF}
+    if hasattr(errno, 'ENOTSUP'):
+        UNSUPPORTED.add(errno.ENOTSUP)
+
+    def __init__(self, verify=False):
+        # With verify on, the file goes through the buffer so its hash can
+        # be taken as it is read, and the destination is read back and
+        # checked against it before the source is removed
+        self.verify = verify
+        self.unsupported = set()
+
+    def methods(self):
+        if fcntl is not None and sys.platform.startswith('linux'):
+            yield 'clone', self.clone
+        if not self.verify:
+            if hasattr(os, 'copy_file_range'):
+                yield 'copy_file_range', self.copy_range
+            if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+                yield 'sendfile', self.send
+        yield 'buffer', self.copy_buffer
+
+    # Copies src to dest (replacing it) and returns (method, digest). The
+    # digest is the content hash when verify is on, otherwise None.
+    # throttle.copied() is told about every chunk written.
+    def copy(self, src, dest, st, throttle=None):
+        throttle = throttle or Throttle()
+        partial = partial_path(dest)
+        fd_in = os.open(src, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+        try:
+            fd_out = os.open(partial, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_CLOEXEC', 0), 0o600)
+            try:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(fd_in, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                method, digest = self.copy_data(fd_in, fd_out, st, os.fstat(fd_out).st_dev, throttle)
+                self.copy_metadata(src, partial, fd_out, st)
+                os.fsync(fd_out)
+                if self.verify and method != 'clone':
+                    self.check(fd_out, st.st_size, digest, dest)
+            finally:
+                os.close(fd_out)
+            os.replace(partial, dest)
+            # The new name has to be on disk too before the caller removes
+            # the source from the other filesystem
+            self.sync_dir(os.path.dirname(dest))
+        except BaseException:
+            try:
+                os.unlink(partial)
+            except OSError:
+                pass
+            raise
+        finally:
+            os.close(fd_in)
+        return method, digest
+
+    @staticmethod
+    def sync_dir(path):
+        if os.name != 'posix':
+            # Windows can't open a directory to flush it
+            return
+        fd = os.open(path or '.', os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def copy_data(self, fd_in, fd_out, st, dest_dev, throttle):
+        devices = (st.st_dev, dest_dev)
+        offset = 0
+        for name, method in self.methods():
+            if (name, devices) in self.unsupported:
+                continue
+            try:
+                offset, digest = method(fd_in, fd_out, offset, st.st_size, throttle)
+            except OSError as e:
+                if e.errno not in self.UNSUPPORTED:
+                    raise
+                self.unsupported.add((name, devices))
+                continue
+            if offset >= st.st_size or name == 'buffer':
+                return name, digest
+            # Some filesystems stop short (copy_file_range returns 0 on
+            # procfs-like files); the next way carries on from there
+        raise OSError(errno.EIO, "could not copy the file")
+
+    def clone(self, fd_in, fd_out, offset, size, throttle):
+        if offset:
+            raise OSError(errno.EINVAL, "clone needs an empty destination")
+        fcntl.ioctl(fd_out, self.FICLONE, fd_in)
+        return size, None
+
+    def copy_range(self, fd_in, fd_out, offset, size, throttle):
+        chunk = throttle.chunk_size or self.CHUNK_SIZE
+        while offset < size:
+            n = os.copy_file_range(fd_in, fd_out, min(chunk, size - offset), offset, offset)
+            if n == 0:
+                break
+            offset += n
+            throttle.copied(n)
+        return offset, None
+
+    def send(self, fd_in, fd_out, offset, size, throttle):
+        chunk = throttle.chunk_size or self.CHUNK_SIZE
+        os.lseek(fd_out, offset, os.SEEK_SET)
+        while offset < size:
+            n = os.sendfile(fd_out, fd_in, offset, min(chunk, size - offset))
+            if n == 0:
+                break
+            offset += n
+            throttle.copied(n)
+        return offset, None
+
+    def copy_buffer(self, fd_in, fd_out, offset, size, throttle):
+        digest = hashlib.blake2b(digest_size=20) if self.verify else None
+        view = memoryview(bytearray(min(self.BUFFER_SIZE, throttle.chunk_size or self.BUFFER_SIZE)))
+        if offset and digest is not None:
+            # Hash what an earlier way already copied
+            self.hash_fd(fd_out, offset, digest, view)
+        os.lseek(fd_in, offset, os.SEEK_SET)
+        os.lseek(fd_out, offset, os.SEEK_SET)
+        with open(fd_in, 'rb', buffering=0, closefd=False) as reader:
+            while True:
+                n = reader.readinto(view)
+                if not n:
+                    break
+                if digest is not None:
+                    digest.update(view[:n])
+                written = 0
+                while written < n:
+                    written += os.write(fd_out, view[written:n])
+                offset += n
+                throttle.copied(n)
+        return offset, digest.hexdigest() if digest is not None else None
+
+    def copy_metadata(self, src, partial, fd_out, st):
+        # copystat carries over the extended attributes and flags as well
+        try:
+            shutil.copystat(src, partial)
+        except OSError as e:
+            logging.error(f"Could not copy the attributes of {src}: {str(e)}")
+            os.chmod(fd_out, S_IMODE(st.st_mode))
+            os.utime(fd_out, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def check(self, fd_out, size, expected, dest):
+        # Drop the cached pages first so the read back comes from the disk
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd_out, 0, 0, os.POSIX_FADV_DONTNEED)
+        digest = hashlib.blake2b(digest_size=20)
+        self.hash_fd(fd_out, size, digest, memoryview(bytearray(self.BUFFER_SIZE)))
+        if digest.hexdigest() != expected:
+            raise OSError(errno.EIO, f"checksum mismatch copying to {dest}")
+
+    @staticmethod
+    def hash_fd(fd, size, digest, view):
+        os.lseek(fd, 0, os.SEEK_SET)
+        with open(fd, 'rb', buffering=0, closefd=False) as reader:
+            left = size
+            while left:
+                n = reader.readinto(view[:min(len(view), left)])
+                if not n:
+                    break
+                digest.update(view[:n])
+                left -= n
+
+
+class MoveExecutor:
+    # Carries out the move stage. A move within one filesystem is a single
+    # os.rename done inline, while moves that need a copy (a category folder
+    # on another device) run on a thread pool with a bounded number in
+    # flight, so slow destinations always have work queued.
+    def __init__(self, max_workers=4, metrics=None, copier=None, cache=None, throttle=None):
+        self.max_workers = max(1, max_workers)
+        self.metrics = metrics or RunMetrics()
+        self.copier = copier or FileCopier()
+        self.throttle = throttle or Throttle()
+        # Hashes taken while verifying copies are kept here for dedupe
+        self.cache = cache
+        self.pool = None
+        self.slots = threading.BoundedSemaphore(self.max_workers * 2)
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # Wait for copies still in flight
+        if self.pool:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+    # on_done(error) is called once the move has finished, with error set to
+    # None on success. Calls are serialized so it doesn't need its own lock.
+    def submit(self, src, dest, same_device, on_done):
+        self.throttle.move()
+        if same_device:
+            start = time.perf_counter()
+            try:
+                os.rename(src, dest)
+            except OSError as e:
+                # EXDEV means it wasn't really the same filesystem after
+                # all (a bind mount, say), so fall back to copying
+                if e.errno != errno.EXDEV:
+                    self.finish(on_done, e)
+                    return
+            else:
+                self.metrics.observe_move(time.perf_counter() - start)
+                self.finish(on_done, None)
+                return
+
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='mover')
+
+        # Block the scan while too many copies are queued
+        self.slots.acquire()
+        self.pool.submit(self.copy_move, src, dest, on_done)
+
+    def copy_move(self, src, dest, on_done):
+        start = time.perf_counter()
+        try:
+            st = os.lstat(src)
+            if S_ISLNK(st.st_mode):
+                shutil.move(src, dest)
+            else:
+                method, digest = self.copier.copy(src, dest, st, self.throttle)
+                os.unlink(src)
+                if method == 'clone':
+                    self.metrics.count('reflinks')
+                if digest is not None and self.cache is not None:
+                    self.cache.put_hashes(os.stat(dest), full=digest)
+            self.metrics.observe_move(time.perf_counter() - start, st.st_size)
+            error = None
+        except Exception as e:
+            error = e
+        finally:
+            self.slots.release()
+        self.finish(on_done, error)
+
+    def finish(self, on_done, error):
+        with self.lock:
+            on_done(error)
+
+
+class FileEntry:
+    # Stands in for os.DirEntry when a file is known by name (from a watcher
+    # event) instead of from a scandir listing
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_file(self):
+        try:
+            return S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+
+class WriteCheck:
+    # Holds back the files of a run that may still be being written. A
+    # file goes ahead once its size and mtime have stayed the same for
+    # `quiet` seconds, going by the snapshot kept from earlier runs or, for
+    # a file not seen before, by its mtime. The stat is the one the scan
+    # already needs and the snapshot only keeps the files held back, so
+    # the check is one dict lookup per file and nothing waits. Paths in
+    # `writing` (see open_for_writing) are held back whatever their age.
+    def __init__(self, previous, quiet, writing=()):
+        self.previous = previous
+        self.quiet = quiet
+        self.writing = writing
+        self.held = {}
+        self.now = time.time()
+
+    def settled(self, entries):
+        for entry in entries:
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            key = (st.st_size, st.st_mtime_ns)
+            seen = self.previous.get(entry.path)
+            if seen is None:
+                since = st.st_mtime_ns / 1e9
+            elif seen[:2] == key:
+                since = seen[2]
+            else:
+                since = self.now
+            if self.now - since < self.quiet or entry.path in self.writing:
+                self.held[entry.path] = key + (since,)
+            else:
+                yield entry
+
+
+class TreeScanner:
+    # Walks a folder tree for recursive runs with a pool of threads, so
+    # reading directories isn't held to one thread's round trips. Each
+    # worker has its own deque of directories still to read: it pushes the
+    # subdirectories it finds and takes the newest back (depth first, which
+    # keeps the deques short), and a worker with nothing left steals the
+    # oldest directory from another one, which is the top of a big subtree
+    # nobody has started on. Files are passed to on_files by the worker that
+    # listed them, SCAN_BATCH at a time, and batches() yields what it
+    # returns in the caller's thread.
+    # select(relative path) decides about each directory and returns
+    # (descend, take files).
+    def __init__(self, root, workers=8, select=None, on_files=None):
+        self.root = root
+        self.workers = max(1, workers)
+        self.select = select or (lambda rel: (True, True))
+        self.on_files = on_files or (lambda entries: entries)
+        self.deques = [collections.deque() for _ in range(self.workers)]
+        self.pending = 0  # directories queued or being read
+        self.running = 0
+        self.cancelled = False
+        self.cond = threading.Condition()
+        self.results = queue.Queue(maxsize=self.workers * 4)
+
+    def batches(self):
+        self.pending = 1
+        self.running = self.workers
+        self.deques[0].append((self.root, '', True))
+        threads = [threading.Thread(target=self.work, args=(i,), name=f'scanner-{i}', daemon=True)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self.results.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # Stop the workers if the caller gave up early
+            with self.cond:
+                self.cancelled = True
+                self.cond.notify_all()
+            for thread in threads:
+                thread.join()
+
+    def work(self, i):
+        own = self.deques[i]
+        try:
+            while True:
+                item = self.take(i, own)
+                if item is None:
+                    return
+                try:
+                    self.read(own, *item)
+                finally:
+                    with self.cond:
+                        self.pending -= 1
+                        if not self.pending:
+                            self.cond.notify_all()
+        except BaseException as e:
+            self.put(e)
+            with self.cond:
+                self.cancelled = True
+                self.cond.notify_all()
+        finally:
+            with self.cond:
+                self.running -= 1
+                last = not self.running
+            if last:
+                self.put(None)
+
+    def take(self, i, own):
+        while True:
+            try:
+                return own.pop()
+            except IndexError:
+                pass
+            for n in range(1, self.workers):
+                try:
+                    return self.deques[(i + n) % self.workers].popleft()
+                except IndexError:
+                    pass
+            # Directories are queued with the lock held, so if none are
+            # visible here, none are coming until someone notifies
+            with self.cond:
+                while not any(self.deques):
+                    if self.cancelled or not self.pending:
+                        return None
+                    self.cond.wait()
+
+    def read(self, own, path, rel, take):
+        files, subdirs = [], []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub = os.path.join(rel, entry.name) if rel else entry.name
+                            descend, take_files = self.select(sub)
+                            if descend:
+                                subdirs.append((entry.path, sub, take_files))
+                        elif take and entry.is_file():
+                            files.append(entry)
+                            if len(files) >= SCAN_BATCH:
+                                self.put(self.on_files(files))
+                                files = []
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.error(f"Error scanning {path}: {str(e)}")
+
+        if subdirs:
+            with self.cond:
+                self.pending += len(subdirs)
+                own.extend(subdirs)
+                self.cond.notify(len(subdirs))
+        if files:
+            self.put(self.on_files(files))
+
+    def put(self, item):
+        # The queue is bounded so the scan can't run far ahead of the moves
+        while True:
+            try:
+                self.results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if self.cancelled:
+                    return
+
+
+class InotifyWatcher:
+    # Reports files written to or moved into a folder using Linux inotify
+    # through ctypes. wait() returns the new names, or None if the kernel
+    # queue overflowed and the folder needs a full scan.
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, path):
+        lazy_import(ctypes='ctypes')
+        # The process's own symbols include libc's, without the ldconfig
+        # search find_library does
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        # IN_CLOSE_WRITE rather than IN_CREATE, so a file is only reported
+        # once whoever created it has finished writing
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"inotify_add_watch failed for {path}")
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        names = set()
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & (self.IN_Q_OVERFLOW | self.IN_IGNORED):
+                return None
+            if name and not mask & self.IN_ISDIR:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    # Fallback for platforms without inotify. Costs one stat of the folder
+    # per poll and only lists it again when the folder's mtime has changed.
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.known = set()
+        self.check()
+
+    def check(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.mtime:
+            return set()
+        self.mtime = mtime
+
+        with os.scandir(self.path) as entries:
+            current = {entry.name for entry in entries if entry.is_file()}
+        new = current - self.known
+        self.known = current
+        return new
+
+    def wait(self, timeout):
+        names = self.check()
+        if not names:
+            time.sleep(timeout)
+        return names
+
+    def close(self):
+        pass
+
+
+def open_watcher(path):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError) as e:
+            logging.error(f"inotify unavailable, falling back to polling: {str(e)}")
+    return PollingWatcher(path)
+
+
+class HistoryJournal:
+    # The organization history as an append-only JSON Lines file. Each run
+    # is written as one line when it finishes and an undo appends a short
+    # marker line, so saving never rewrites the history that came before.
+    # The file is rewritten (compacted) only when undone or expired runs
+    # start to outweigh the live ones.
+    #
+    # Runs are stored column-wise: the folders are listed once per run
+    # (category folders by name) and each move is an index into that list,
+    # a file name and a millisecond offset from the run's first move. Only
+    # run summaries are kept in memory; a run's moves are read back from
+    # the file by offset when they are needed (undo), so memory doesn't
+    # grow with the number of files organized.
+    SUMMARY_KEYS = ('id', 'timestamp', 'source', 'total_moved', 'total_files', 'metrics', 'wal')
+
+    def __init__(self, path=HISTORY_FILE, max_runs=1000, max_age_days=None, fsync_interval=2.0):
+        self.path = path
+        self.max_runs = max_runs
+        self.max_age_days = max_age_days
+        self.fsync_interval = fsync_interval
+        self.file = None
+        self.next_id = 1
+        self.dead_records = 0
+        self.last_sync = 0
+        self.unsynced = False
+
+    @classmethod
+    def summary(cls, record, offset):
+        run = {key: record[key] for key in cls.SUMMARY_KEYS if key in record}
+        run['offset'] = offset
+        return run
+
+    def load(self):
+        runs = {}
+        good_size = 0
+        self.dead_records = 0
+
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    # A line without a newline is a torn write from a crash
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        record = self.parse_summary(line)
+                    except ValueError:
+                        break
+                    offset = good_size
+                    good_size += len(line)
+
+                    if 'undo' in record:
+                        if runs.pop(record['undo'], None) is not None:
+                            self.dead_records += 2
+                    else:
+                        # A later line with the same id replaces the run
+                        # (part of it was undone) and keeps its place
+                        if record['id'] in runs:
+                            self.dead_records += 1
+                        runs[record['id']] = self.summary(record, offset)
+                        self.next_id = max(self.next_id, record['id'] + 1)
+
+            if good_size < os.path.getsize(self.path):
+                logging.error(f"Discarding damaged tail of {self.path}")
+                with open(self.path, 'r+b') as f:
+                    f.truncate(good_size)
+
+        return list(runs.values())
+
+    # Loading only needs each run's summary, which encode writes ahead of
+    # the columns, so the columns are cut off unparsed. A quote can't
+    # appear unescaped inside a JSON string, so the first ',"dirs":' is
+    # where they start.
+    @staticmethod
+    def parse_summary(line):
+        cut = line.find(b',"dirs":')
+        if cut < 0:
+            return json.loads(line)
+        return json.loads(line[:cut] + b'}')
+
+    def open(self):
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+        return self.file
+
+    # Returns the offset the record was written at
+    def write(self, record):
+        f = self.open()
+        offset = f.tell()
+        f.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+        f.flush()
+        self.unsynced = True
+        self.sync()
+        return offset
+
+    # fsync at most once every fsync_interval seconds unless forced, so a
+    # burst of small runs shares one disk flush
+    def sync(self, force=False):
+        if not self.unsynced or self.file is None:
+            return
+        now = time.monotonic()
+        if force or now - self.last_sync >= self.fsync_interval:
+            os.fsync(self.file.fileno())
+            self.last_sync = now
+            self.unsynced = False
+
+    @staticmethod
+    def encode(run, operations):
+        source = run['source']
+        record = {key: run[key] for key in HistoryJournal.SUMMARY_KEYS if key in run}
+        dirs = {}
+        names, dst, offsets, targets, replaced, sources = [], [], [], [], [], []
+        base = datetime.fromisoformat(operations[0]['timestamp']).timestamp() if operations else 0
+        prefix = os.path.join(source, '')
+
+        def intern(path):
+            # Category folders and subfolders are stored relative to the
+            # source, anything else in full
+            key = os.path.relpath(path, source) if path.startswith(prefix) else os.path.abspath(path)
+            if key not in dirs:
+                dirs[key] = len(dirs)
+            return dirs[key]
+
+        for i, operation in enumerate(operations):
+            names.append(operation['filename'])
+            dst.append(intern(operation['destination']))
+            offsets.append(round((datetime.fromisoformat(operation['timestamp']).timestamp() - base) * 1000))
+            if 'target' in operation:
+                targets.append([i, operation['target']])
+            if operation.get('replaced'):
+                replaced.append(i)
+            if operation['source'] != source:
+                sources.append([i, intern(operation['source'])])
+
+        record.update(dirs=list(dirs), names=names, dst=dst, t0=base, t=offsets)
+        if targets:
+            record['targets'] = targets
+        if replaced:
+            record['replaced'] = replaced
+        if sources:
+            record['sources'] = sources
+        return record
+
+    @staticmethod
+    def decode(record):
+        # Lines written before the columnar format carry the list as is
+        if 'operations' in record:
+            return record['operations']
+
+        source = record['source']
+        dirs = [os.path.join(source, d) for d in record['dirs']]
+        targets = dict(record.get('targets', ()))
+        replaced = set(record.get('replaced', ()))
+        # Older records give the source folders in full instead of by index
+        sources = {i: dirs[d] if isinstance(d, int) else d for i, d in record.get('sources', ())}
+        base = record['t0']
+        operations = []
+        for i, (name, d, offset) in enumerate(zip(record['names'], record['dst'], record['t'])):
+            operation = {
+                'filename': name,
+                'source': sources.get(i, source),
+                'destination': dirs[d],
+                'timestamp': datetime.fromtimestamp(base + offset / 1000).isoformat()
+            }
+            if i in targets:
+                operation['target'] = targets[i]
+            if i in replaced:
+                operation['replaced'] = True
+            operations.append(operation)
+        return operations
+
+    # Writes a finished run (with its 'operations' list) and returns its
+    # summary, which is what callers keep
+    def append(self, run):
+        run['id'] = self.next_id
+        self.next_id += 1
+        record = self.encode(run, run['operations'])
+        return self.summary(record, self.write(record))
+
+    # Writes a new version of a run that keeps only `operations`, under the
+    # same id, and returns its summary
+    def replace(self, run, operations):
+        run = dict(run, total_moved=len(operations))
+        record = self.encode(run, operations)
+        self.dead_records += 1
+        return self.summary(record, self.write(record))
+
+    # The moves of a run, read back from the file
+    def operations(self, run):
+        if self.file is not None:
+            self.file.flush()
+        with open(self.path, 'rb') as f:
+            f.seek(run['offset'])
+            return self.decode(json.loads(f.readline()))
+
+    def append_undo(self, run):
+        self.write({'undo': run['id'], 'timestamp': datetime.now().isoformat()})
+        self.dead_records += 2
+
+    # Number of runs at the start of `runs` that fall outside the retention
+    # policy (oldest first)
+    def expired_count(self, runs):
+        expired = max(0, len(runs) - self.max_runs) if self.max_runs else 0
+        if self.max_age_days:
+            cutoff = datetime.now().timestamp() - self.max_age_days * 86400
+            while expired < len(runs) and datetime.fromisoformat(runs[expired]['timestamp']).timestamp() < cutoff:
+                expired += 1
+        return expired
+
+    def needs_compaction(self, runs):
+        return self.dead_records > max(100, len(runs))
+
+    # Rewrite the journal with only the live runs, replacing it atomically.
+    # The runs' offsets are updated to their new places.
+    def compact(self, runs):
+        if self.file is not None:
+            self.file.flush()
+        tmp_path = self.path + '.tmp'
+        offsets = []
+        with open(self.path, 'rb') as old, open(tmp_path, 'wb') as f:
+            for run in runs:
+                old.seek(run['offset'])
+                record = json.loads(old.readline())
+                if 'operations' in record:
+                    record = self.encode(record, record['operations'])
+                offsets.append(f.tell())
+                f.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.close()
+        os.replace(tmp_path, self.path)
+        for run, offset in zip(runs, offsets):
+            run['offset'] = offset
+        self.dead_records = 0
+
+    def close(self):
+        if self.file is not None:
+            self.sync(force=True)
+            self.file.close()
+            self.file = None
+
+
+class MoveLog:
+    # Write-ahead log of the moves a run is about to make, so a run cut
+    # short by a crash can be finished or rolled back on the next start.
+    # Intents are written in batches and made durable with one fsync per
+    # batch before any file in it is moved. Completions are written without
+    # an fsync: on recovery a move whose completion was lost is recognized
+    # by its file already being at the target. A run's records stop
+    # mattering once its history record is on disk, and the file is emptied
+    # whenever no run is left open.
+    def __init__(self, path=WAL_FILE):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+        self.runs = {}
+        self.interrupted = []
+        self.unsynced = False
+
+    # Returns the runs that were still open when the process stopped, each
+    # as its begin record plus 'moves' (n -> intent) and 'done' (set of n)
+    def load(self):
+        runs = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    # A torn last line is a write the crash cut short
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+
+                    if 'begin' in record:
+                        runs[record['begin']] = dict(record, moves={}, done=set())
+                    elif 'end' in record:
+                        runs.pop(record['end'], None)
+                    elif record.get('run') in runs:
+                        if 'done' in record:
+                            runs[record['run']]['done'].add(record['done'])
+                        else:
+                            runs[record['run']]['moves'][record['n']] = record
+        self.interrupted = list(runs.values())
+        return self.interrupted
+
+    def write(self, record):
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.unsynced = True
+
+    # The begin record is only written with the run's first intent, so runs
+    # that move nothing cost no I/O
+    def begin(self, kind, source, **extra):
+        with self.lock:
+            run_id = f"{time.time_ns():x}"
+            self.runs[run_id] = {'header': dict(begin=run_id, kind=kind, source=source, **extra), 'next': 0}
+        return run_id
+
+    def intent(self, run_id, move_from, move_to, operation):
+        with self.lock:
+            run = self.runs[run_id]
+            if run['header'] is not None:
+                self.write(run['header'])
+                run['header'] = None
+            n = run['next']
+            run['next'] += 1
+            self.write({'run': run_id, 'n': n, 'from': move_from, 'to': move_to, 'op': operation})
+        return n
+
+    # Group commit: one flush and fsync covers every intent written so far
+    def commit(self):
+        with self.lock:
+            if self.unsynced and self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.unsynced = False
+
+    def done(self, run_id, n):
+        with self.lock:
+            self.write({'run': run_id, 'done': n})
+
+    def written(self, run_id):
+        return self.runs[run_id]['header'] is None
+
+    def end(self, run_id):
+        with self.lock:
+            run = self.runs.pop(run_id)
+            if run['header'] is None:
+                self.write({'end': run_id})
+            self.checkpoint()
+
+    def resolved(self, run):
+        with self.lock:
+            self.interrupted.remove(run)
+            self.checkpoint()
+
+    def checkpoint(self):
+        # Called with the lock held. Once nothing is open or waiting for
+        # recovery, none of the records are needed any more.
+        if self.runs or self.interrupted or (self.file is None and not os.path.exists(self.path)):
+            return
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        open(self.path, 'w').close()
+        self.unsynced = False
+
+    def close(self):
+        self.commit()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class ContentCache:
+    # Persistent cache of facts about file contents (hashes) that are
+    # expensive to compute. Rows are keyed by (device, inode, size,
+    # mtime_ns), so an unchanged file is never read twice, and the key
+    # survives the file being renamed into its category folder.
+    def __init__(self, path=CACHE_FILE, max_age_days=90):
+        self.path = path
+        self.max_age_days = max_age_days
+        self.db = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS hashes ('
+                'dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+                'partial TEXT, full TEXT, updated REAL, '
+                'PRIMARY KEY (dev, ino, size, mtime_ns))'
+            )
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS magic ('
+                'dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+                'ext TEXT, strong INTEGER, updated REAL, '
+                'PRIMARY KEY (dev, ino, size, mtime_ns))'
+            )
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS folders ('
+                'path TEXT PRIMARY KEY, mtime_ns INTEGER, sizes TEXT, updated REAL)'
+            )
+            # Forget files that haven't been looked at in a long time
+            cutoff = time.time() - self.max_age_days * 86400
+            self.db.execute('DELETE FROM hashes WHERE updated < ?', (cutoff,))
+            self.db.execute('DELETE FROM magic WHERE updated < ?', (cutoff,))
+            self.db.execute('DELETE FROM folders WHERE updated < ?', (cutoff,))
+            self.db.commit()
+        return self.db
+
+    @staticmethod
+    def key(st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    # Returns (partial, full); either may be None if not known yet
+    def get_hashes(self, st):
+        with self.lock:
+            row = self.open().execute(
+                'SELECT partial, full FROM hashes WHERE dev=? AND ino=? AND size=? AND mtime_ns=?',
+                self.key(st)
+            ).fetchone()
+        return row if row else (None, None)
+
+    def put_hashes(self, st, partial=None, full=None):
+        with self.lock:
+            self.open().execute(
+                'INSERT INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (dev, ino, size, mtime_ns) DO UPDATE SET '
+                'partial=coalesce(excluded.partial, partial), '
+                'full=coalesce(excluded.full, full), updated=excluded.updated',
+                self.key(st) + (partial, full, time.time())
+            )
+
+    # Returns (extension, strong) as sniffed, with '' for a type that wasn't
+    # recognized, or None if the file hasn't been sniffed yet
+    def get_sniff(self, st):
+        with self.lock:
+            row = self.open().execute(
+                'SELECT ext, strong FROM magic WHERE dev=? AND ino=? AND size=? AND mtime_ns=?',
+                self.key(st)
+            ).fetchone()
+        return (row[0], bool(row[1])) if row else None
+
+    def put_sniff(self, st, ext, strong):
+        with self.lock:
+            self.open().execute(
+                'INSERT OR REPLACE INTO magic VALUES (?, ?, ?, ?, ?, ?, ?)',
+                self.key(st) + (ext, int(strong), time.time())
+            )
+
+    # Returns (folder mtime_ns, {name: size}) as last saved for the folder,
+    # or (None, {}) if it was never indexed
+    def get_folder_sizes(self, path):
+        with self.lock:
+            row = self.open().execute(
+                'SELECT mtime_ns, sizes FROM folders WHERE path=?', (path,)
+            ).fetchone()
+        return (row[0], json.loads(row[1])) if row else (None, {})
+
+    def put_folder_sizes(self, path, mtime_ns, sizes):
+        with self.lock:
+            self.open().execute(
+                'INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)',
+                (path, mtime_ns, json.dumps(sizes, separators=(',', ':')), time.time())
+            )
+
+    def commit(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+
+class DuplicateFinder:
+    # Finds files with identical contents in three tiers, each only run on
+    # what the previous tier couldn't tell apart: group by size (free, from
+    # the scan's stat), then hash the first and last 64 KiB, then hash the
+    # whole file.
+    PARTIAL_SIZE = 64 * 1024
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, cache, workers=4):
+        self.cache = cache
+        self.workers = max(1, workers)
+
+    # files is a list of (path, stat_result, is_new). Only new files are
+    # reported as duplicates; existing ones can only be the original.
+    # Returns {duplicate_path: original_path}.
+    def find(self, files):
+        # Empty files are all "identical", which isn't useful to report
+        files = [f for f in files if f[1].st_size]
+        groups = self.split(files, lambda f: f[1].st_size)
+
+        # Files no bigger than the two partial blocks are read whole by the
+        # partial hash, so that hash is already final
+        small = [g for g in groups if g[0][1].st_size <= 2 * self.PARTIAL_SIZE]
+        large = [g for g in groups if g[0][1].st_size > 2 * self.PARTIAL_SIZE]
+
+        partial = self.hash_all([f for g in small + large for f in g], 'partial')
+        identical = self.regroup(small, partial)
+        large = self.regroup(large, partial)
+
+        full = self.hash_all([f for g in large for f in g], 'full')
+        identical += self.regroup(large, full)
+        self.cache.commit()
+
+        duplicates = {}
+        for group in identical:
+            # Prefer an already organized file as the original, then the oldest
+            group.sort(key=lambda f: (f[2], f[1].st_mtime_ns))
+            original = group[0][0]
+            for path, _, is_new in group[1:]:
+                if is_new:
+                    duplicates[path] = original
+        return duplicates
+
+    # Group files by key, keeping only groups that could hold a duplicate
+    def split(self, files, key):
+        groups = {}
+        for f in files:
+            groups.setdefault(key(f), []).append(f)
+        return [g for g in groups.values() if len(g) > 1 and any(f[2] for f in g)]
+
+    def regroup(self, groups, hashes):
+        result = []
+        for group in groups:
+            result += self.split([f for f in group if hashes.get(f[0])], lambda f: hashes[f[0]])
+        return result
+
+    def hash_all(self, files, kind):
+        hashes = {}
+        todo = []
+        for f in files:
+            cached = self.cache.get_hashes(f[1])[0 if kind == 'partial' else 1]
+            if cached:
+                hashes[f[0]] = cached
+            else:
+                todo.append(f)
+
+        if todo:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for f, digest in zip(todo, pool.map(lambda f: self.hash_file(f[0], f[1].st_size, kind), todo)):
+                    if digest is None:
+                        continue
+                    hashes[f[0]] = digest
+                    if kind == 'partial':
+                        self.cache.put_hashes(f[1], partial=digest)
+                    else:
+                        self.cache.put_hashes(f[1], full=digest)
+        return hashes
+
+    def hash_file(self, path, size, kind):
+        digest = hashlib.blake2b(digest_size=20)
+        try:
+            with open(path, 'rb') as f:
+                if kind == 'partial':
+                    digest.update(f.read(self.PARTIAL_SIZE))
+                    if size > 2 * self.PARTIAL_SIZE:
+                        f.seek(-self.PARTIAL_SIZE, os.SEEK_END)
+                    digest.update(f.read(self.PARTIAL_SIZE))
+                else:
+                    for block in iter(lambda: f.read(self.READ_SIZE), b''):
+                        digest.update(block)
+        except OSError as e:
+            logging.error(f"Error hashing {path}: {str(e)}")
+            return None
+        return digest.hexdigest()
+
+
+class ContentSniffer:
+    # Works out a file's real type from the magic bytes at its start, for
+    # files with no extension or the wrong one. Only the first HEADER_SIZE
+    # bytes are read, in one read call, and results are cached by
+    # (device, inode, size, mtime_ns).
+    HEADER_SIZE = 4096
+
+    # (offset, magic bytes, extension, strong); more specific signatures
+    # come first. Only strong signatures may override a known extension:
+    # the weak ones are short or plain text, so a text file can start with
+    # them by chance, and they only fill in files with unknown extensions.
+    SIGNATURES = [
+        (0, b'\x89PNG\r\n\x1a\n', '.png', True),
+        (0, b'\xff\xd8\xff', '.jpg', True),
+        (0, b'GIF87a', '.gif', True),
+        (0, b'GIF89a', '.gif', True),
+        (0, b'II*\x00', '.tiff', True),
+        (0, b'MM\x00*', '.tiff', True),
+        (0, b'%PDF-', '.pdf', True),
+        (0, b'{\\rtf', '.rtf', True),
+        (0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', '.doc', True),
+        (0, b'PK\x03\x04', '.zip', True),
+        (0, b'Rar!\x1a\x07', '.rar', True),
+        (0, b"7z\xbc\xaf'\x1c", '.7z', True),
+        (0, b'\x1f\x8b\x08', '.gz', True),
+        (0, b'BZh', '.bz2', False),
+        (257, b'ustar', '.tar', True),
+        (0, b'RIFF', '.riff', True),
+        (4, b'ftyp', '.mp4', True),
+        (0, b'\x1aE\xdf\xa3', '.mkv', True),
+        (0, b'0&\xb2u\x8ef\xcf\x11', '.wmv', True),
+        (0, b'FLV\x01', '.flv', True),
+        (0, b'fLaC', '.flac', True),
+        (0, b'OggS', '.ogg', True),
+        (0, b'ID3', '.mp3', True),
+        (0, b'\xff\xfb', '.mp3', False),
+        (0, b'\xff\xf3', '.mp3', False),
+        (0, b'\xff\xf2', '.mp3', False),
+        (0, b'\xff\xf1', '.aac', False),
+        (0, b'\xff\xf9', '.aac', False),
+        (0, b'!<arch>\ndebian', '.deb', True),
+        (0, b'\xed\xab\xee\xdb', '.rpm', True),
+        (0, b'MZ', '.exe', True),
+        (0, b'#!', '.sh', False),
+        (0, b'<?xml', '.xml', False),
+        (0, b'<svg', '.svg', False),
+        (0, b'BM', '.bmp', True),
+    ]
+
+    # Container formats told apart by what follows the signature
+    RIFF_TYPES = {b'WEBP': '.webp', b'WAVE': '.wav', b'AVI ': '.avi'}
+    FTYP_BRANDS = {b'qt  ': '.mov', b'M4V ': '.m4v', b'M4A ': '.m4a'}
+    ZIP_MARKERS = [(b'word/', '.docx'), (b'xl/', '.xlsx'), (b'ppt/', '.pptx'),
+                   (b'opendocument.text', '.odt')]
+    # Header sizes of the BMP DIB header versions
+    BMP_DIB_SIZES = {12, 40, 52, 56, 64, 108, 124}
+
+    def __init__(self, cache, workers=4):
+        self.cache = cache
+        self.workers = max(1, workers)
+        self.pool = None
+
+    # Returns {path: (extension, strong)} for the entries whose type was
+    # recognized
+    def sniff_all(self, entries):
+        found = {}
+        todo = []
+        for entry in entries:
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            cached = self.cache.get_sniff(st)
+            if cached is None:
+                todo.append((entry.path, st))
+            elif cached[0]:
+                found[entry.path] = cached
+
+        if todo:
+            # Header reads are tiny, so run them side by side to keep the
+            # disk busy rather than waiting on one file at a time
+            self.start()
+            for (path, st), result in zip(todo, self.pool.map(self.sniff_file, [path for path, _ in todo])):
+                if result is not None:
+                    self.cache.put_sniff(st, *result)
+                    if result[0]:
+                        found[path] = result
+            self.cache.commit()
+
+        return found
+
+    # Returns (extension, strong) with '' for a type that isn't recognized,
+    # or None if the file couldn't be read
+    def sniff_file(self, path):
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                header = f.read(self.HEADER_SIZE)
+        except OSError:
+            return None
+        return self.match(header)
+
+    def match(self, header):
+        for offset, magic, ext, strong in self.SIGNATURES:
+            if header.startswith(magic, offset) and self.valid(ext, header):
+                break
+        else:
+            return ('', False)
+
+        if ext == '.riff':
+            ext = self.RIFF_TYPES.get(header[8:12], '')
+        elif ext == '.mp4':
+            # Plenty of other formats (HEIC, 3GP, ...) use ftyp too, so only
+            # a known brand is sure
+            ext = self.FTYP_BRANDS.get(header[8:12], '.mp4')
+            strong = header[8:12] in self.FTYP_BRANDS or header[8:11] in (b'mp4', b'iso')
+        elif ext == '.mkv' and b'webm' in header[:64]:
+            ext = '.webm'
+        elif ext == '.xml' and b'<svg' in header:
+            ext = '.svg'
+        elif ext == '.zip':
+            # Plain zip is also the container of jar, epub, apk and others
+            strong = False
+            for marker, office_ext in self.ZIP_MARKERS:
+                if marker in header:
+                    ext, strong = office_ext, True
+                    break
+        return (ext, strong)
+
+    # Checks the fields after a short signature, so a text file that
+    # happens to start with the same letters doesn't match
+    def valid(self, ext, header):
+        if ext == '.bmp':
+            # The file size field, then the DIB header size after the
+            # 14 byte file header
+            return (len(header) >= 18
+                    and int.from_bytes(header[2:6], 'little') >= 26
+                    and int.from_bytes(header[14:18], 'little') in self.BMP_DIB_SIZES)
+        if ext == '.exe':
+            # e_lfanew at 0x3C points to the PE header
+            if len(header) < 0x40:
+                return False
+            pe = int.from_bytes(header[0x3C:0x40], 'little')
+            return header.startswith(b'PE\x00\x00', pe)
+        if ext == '.mp3' and header.startswith(b'ID3'):
+            # ID3v2 version (2 to 4), revision 0 and a synchsafe size
+            return (len(header) >= 10 and header[3] in (2, 3, 4) and header[4] == 0
+                    and all(b < 0x80 for b in header[6:10]))
+        return True
+
+    # Starts every pool thread now, from the calling thread, so they all
+    # take its priority instead of that of whichever run first needs them
+    def start(self):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sniffer')
+            # Each task waits for all the others, so the pool has to start
+            # a thread for every one of them
+            ready = threading.Barrier(self.workers)
+            for _ in range(self.workers):
+                self.pool.submit(ready.wait)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+
+class JobQueue:
+    # Every organize and undo goes through this one queue. Jobs for
+    # different folders run side by side on up to max_workers threads, but
+    # a folder only ever has one job running, and a job without a folder
+    # (undo) runs on its own. Submitting a job with the same key as one
+    # that is still waiting joins that job instead of queueing another.
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.cond = threading.Condition()
+        self.pending = []
+        self.keys = {}
+        self.running = set()
+        self.threads = []
+        self.idle = 0
+        self.closed = False
+
+    def submit(self, func, folder=None, key=None, on_done=None):
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("The job queue is closed")
+
+            job = self.keys.get(key) if key is not None else None
+            if job is not None:
+                logging.info(f"Merged a duplicate {key[0]} request for {folder} into the pending one")
+            else:
+                job = {'func': func, 'folder': folder, 'key': key, 'future': Future(), 'callbacks': []}
+                self.pending.append(job)
+                if key is not None:
+                    self.keys[key] = job
+                if not self.idle and len(self.threads) < self.max_workers:
+                    thread = threading.Thread(target=self.worker, daemon=True)
+                    self.threads.append(thread)
+                    thread.start()
+                self.cond.notify_all()
+
+            if on_done:
+                job['callbacks'].append(on_done)
+            return job['future']
+
+    def next_job(self):
+        # Jobs start in the order they were queued, except that a job
+        # waiting for its folder lets jobs for other folders go ahead
+        if None in self.running:
+            return None
+        for job in self.pending:
+            if job['folder'] is None:
+                # Everything queued after an undo waits for it
+                return None if self.running else job
+            if job['folder'] not in self.running:
+                return job
+        return None
+
+    def worker(self):
+        while True:
+            with self.cond:
+                self.idle += 1
+                job = self.next_job()
+                while job is None and not self.closed:
+                    self.cond.wait()
+                    job = self.next_job()
+                self.idle -= 1
+                if job is None:
+                    return
+                self.pending.remove(job)
+                self.keys.pop(job['key'], None)
+                self.running.add(job['folder'])
+
+            try:
+                result, error = job['func'](), None
+            except Exception as e:
+                result, error = None, e
+
+            with self.cond:
+                self.running.discard(job['folder'])
+                self.cond.notify_all()
+
+            if error is None:
+                job['future'].set_result(result)
+            else:
+                job['future'].set_exception(error)
+            for callback in job['callbacks']:
+                try:
+                    callback(result, error)
+                except Exception as e:
+                    logging.error(f"Error in job callback: {str(e)}")
+
+    # Drops the jobs that haven't started and waits for the running ones
+    def close(self):
+        with self.cond:
+            self.closed = True
+            for job in self.pending:
+                job['future'].cancel()
+            self.pending = []
+            self.keys.clear()
+            self.cond.notify_all()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+
+class OrganizerEngine:
+    # Does the actual organizing work without any UI, so it can be driven
+    # from the Tk app, the scheduler or the command line.
+    def __init__(self, categories=None, state_file=STATE_FILE, rules_file=RULES_FILE,
+                 history_file=HISTORY_FILE, cache_file=CACHE_FILE, wal_file=WAL_FILE):
+        self.rules = RuleTable(categories if categories is not None else DEFAULT_CATEGORIES, rules_file)
+        self.folder_rules = {}
+        self.history_lock = threading.RLock()
+        self.jobs = JobQueue(DEFAULT_SETTINGS['scheduler_workers'])
+        self.state_file = state_file
+        self.journal = HistoryJournal(history_file)
+        self.wal = MoveLog(wal_file)
+        self.cache = ContentCache(cache_file)
+        # Shared by every run so it remembers which copy methods each pair
+        # of filesystems supports
+        self.copier = FileCopier()
+        self.sniffer = None
+        self.last_metrics = None
+        self.total_metrics = RunMetrics()
+        # A deep copy, so adding to a list setting ('folders', the folder
+        # filters) never changes the defaults
+        self.settings = copy.deepcopy(DEFAULT_SETTINGS)
+        self._move_history = None
+        # Folder -> {path: (size, mtime_ns, unchanged since)} for the files
+        # the write check held back, kept from one run to the next
+        self.snapshots = {}
+
+    @property
+    def categories(self):
+        return self.rules.categories
+
+    # Run summaries, read from the journal the first time they are needed
+    # so that starting up only reads the settings
+    @property
+    def move_history(self):
+        if self._move_history is None:
+            self.load_history()
+        return self._move_history
+
+    @move_history.setter
+    def move_history(self, runs):
+        self._move_history = runs
+
+    @property
+    def history_loaded(self):
+        return self._move_history is not None
+
+    def load_history(self):
+        with self.history_lock:
+            if self._move_history is None:
+                self._move_history = []
+                try:
+                    self._move_history = self.journal.load()
+                    self.trim_history()
+                except Exception as e:
+                    print(f"Error loading history: {str(e)}")
+            return self._move_history
+
+    # limits can override the run limits in the settings (a scheduled
+    # folder's own)
+    def move_executor(self, metrics=None, cancel=None, limits=None):
+        settings = dict(self.settings, **(limits or {}))
+        throttle = Throttle(settings['max_moves_per_sec'], settings['max_bytes_per_sec'],
+                            settings['max_io_pressure'], cancel)
+        self.copier.verify = settings['verify_copies']
+        return MoveExecutor(settings['move_workers'], metrics, self.copier, self.cache, throttle)
+
+    # Runs work() and returns its result, on a thread of its own at the
+    # configured lower priority when there is one. A priority can't be
+    # raised again without privileges, so the job queue thread the run was
+    # called on is never lowered itself; the threads the run starts (movers,
+    # scanners) inherit the lowered priority and end with it. The sniffer's
+    # pool outlives runs, so it is started beforehand at normal priority.
+    def at_run_priority(self, limits, work):
+        settings = dict(self.settings, **(limits or {}))
+        if settings['nice'] is None and settings['io_priority'] is None:
+            return work()
+
+        if settings['sniff'] != 'off':
+            self.content_sniffer().start()
+        outcome = {}
+
+        def run():
+            lower_priority(settings['nice'], settings['io_priority'])
+            try:
+                outcome['result'] = work()
+            except BaseException as e:
+                outcome['error'] = e
+
+        thread = threading.Thread(target=run, name='lowered-run')
+        thread.start()
+        thread.join()
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+
+    def content_sniffer(self):
+        with self.history_lock:
+            if self.sniffer is None:
+                self.sniffer = ContentSniffer(self.cache, self.settings['move_workers'])
+            return self.sniffer
+
+    # Scan stage: yield the files directly inside the source folder as
+    # DirEntry objects, using the type information readdir already returned
+    # instead of stat-ing every name
+    def scan(self, source):
+        with os.scandir(source) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        yield entry
+                except OSError:
+                    continue
+
+    # Scan and classify stages for a recursive run. The scan workers
+    # classify what they list, so only the moves are left to this thread.
+    # Category folders hold what earlier runs sorted and are never read.
+    def scan_tree(self, source, metrics, rules, check=None):
+        skip = set(rules.categories) | {category for category, _, _ in rules.rules} | {'Duplicates'}
+        scanner = TreeScanner(
+            source, self.settings['scan_workers'],
+            dir_filter(self.settings['include_dirs'], self.settings['exclude_dirs'], skip),
+            lambda entries: list(self.classified(check.settled(entries) if check else entries, metrics, rules))
+        )
+        for batch in metrics.timed_iter('scan', scanner.batches()):
+            yield from batch
+
+    # Scan stage for files already known by name, such as watcher events
+    def scan_names(self, source, names):
+        for name in names:
+            entry = FileEntry(source, name)
+            if entry.is_file():
+                yield entry
+
+    # Classify stage: find the category for a scanned entry
+    def classify(self, entry, rules=None):
+        return (rules or self.rules).classify(entry.name, entry.stat)
+
+    # The rule table for a folder with its own rules file
+    def rules_for(self, rules_file):
+        if not rules_file or rules_file == self.rules.rules_file:
+            return self.rules
+        with self.history_lock:
+            if rules_file not in self.folder_rules:
+                self.folder_rules[rules_file] = RuleTable(self.rules.base_categories, rules_file)
+            return self.folder_rules[rules_file]
+
+    # Classify entries as they stream past. With content sniffing on they
+    # are taken in batches so the header reads for a batch run in parallel.
+    def classified(self, entries, metrics, rules):
+        mode = self.settings['sniff']
+        if mode == 'off':
+            for entry in entries:
+                start = time.perf_counter()
+                category = rules.classify(entry.name, entry.stat)
+                metrics.add_time('classify', time.perf_counter() - start)
+                yield entry, category
+            return
+
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) >= SNIFF_BATCH:
+                with metrics.timer('classify'):
+                    results = self.classify_batch(batch, mode, rules)
+                yield from results
+                batch = []
+        if batch:
+            with metrics.timer('classify'):
+                results = self.classify_batch(batch, mode, rules)
+            yield from results
+
+    def classify_batch(self, batch, mode, rules):
+        results = []
+        to_sniff = []
+        for entry in batch:
+            category = rules.match_rules(entry.name, entry.stat)
+            if category is None:
+                category = rules.match_extension(entry.name)
+                if mode == 'override' or category == 'Others':
+                    to_sniff.append(entry)
+            results.append((entry, category))
+
+        if not to_sniff:
+            return results
+
+        sniffed = self.content_sniffer().sniff_all(to_sniff)
+
+        for i, (entry, category) in enumerate(results):
+            ext, strong = sniffed.get(entry.path, ('', False))
+            content_category = rules.ext_map.get(ext)
+            if content_category and content_category != category:
+                # Only a strong signature is trusted over a known extension
+                if category != 'Others':
+                    if not strong:
+                        continue
+                    logging.info(f"Content check: {entry.name} is really {ext}, not {category}")
+                results[i] = (entry, content_category)
+        return results
+
+    # Make sure a category folder exists, touching the disk only the first
+    # time each folder is seen during a run. Returns the folder's device.
+    # The category folder's names are read once per run, so name conflicts
+    # are found in memory instead of with a stat per file
+    def ensure_dir(self, category_dir, ready_dirs, metrics):
+        ready = ready_dirs.get(category_dir)
+        if ready is None:
+            with metrics.timer('mkdir'):
+                os.makedirs(category_dir, exist_ok=True)
+                ready = ready_dirs[category_dir] = (os.stat(category_dir).st_dev, NameSet(os.listdir(category_dir)))
+        return ready
+
+    # Works out where one file goes, without touching the disk. Returns
+    # (category, target name, action), or None if the file is skipped.
+    # names_for(category_dir) gives the names already in a category folder.
+    def place(self, source, entry, category, names_for, metrics):
+        filename = entry.name
+        category_dir = os.path.join(source, category)
+        names = names_for(category_dir)
+
+        target = filename
+        action = 'move'
+        if filename in names:
+            metrics.count('conflicts')
+            action, target = self.resolve_conflict(entry, category, category_dir, names)
+            if action == 'skip':
+                logging.info(f"Skipped {filename}: {category} already has a file with that name")
+                return None
+            if action == 'duplicate':
+                logging.info(f"Duplicate: {filename} is identical to the one already in {category}")
+                return self.place(source, entry, 'Duplicates', names_for, metrics)
+        names.add(target)
+        return category, target, action
+
+    # Move stage: work out where one file goes and queue it in `batch`
+    # for flush_moves
+    def move(self, executor, source, source_device, entry, category, ready_dirs, batch):
+        placed = self.place(
+            source, entry, category,
+            lambda category_dir: self.ensure_dir(category_dir, ready_dirs, executor.metrics)[1],
+            executor.metrics
+        )
+        if placed is not None:
+            category, target, action = placed
+            batch.append(self.prepare_move(executor, source, source_device, entry.path, category, target, action,
+                                           ready_dirs))
+
+    # Returns (path, target path, same device, category, undo record)
+    def prepare_move(self, executor, source, source_device, path, category, target, action, ready_dirs):
+        directory, filename = os.path.split(path)
+        category_dir = os.path.join(source, category)
+        device, _ = self.ensure_dir(category_dir, ready_dirs, executor.metrics)
+
+        operation = {
+            'filename': filename,
+            # Files from subfolders of a recursive run go back there on undo
+            'source': source if directory == os.path.normpath(source) else directory,
+            'destination': category_dir,
+            'timestamp': datetime.now().isoformat()
+        }
+        if target != filename:
+            operation['target'] = target
+        if action == 'replace':
+            # The older file of the same name is gone, so undo can only
+            # move this one back
+            operation['replaced'] = True
+        return path, os.path.join(category_dir, target), device == source_device, category, operation
+
+    # Log the batch's intents, make them durable with one fsync and then
+    # hand the moves to the executor. on_done receives the undo record, or
+    # the error if the move failed.
+    def flush_moves(self, executor, run_id, batch, on_done):
+        numbers = [self.wal.intent(run_id, path, dest, operation) for path, dest, _, _, operation in batch]
+        self.wal.commit()
+        for n, (path, dest, same_device, category, operation) in zip(numbers, batch):
+            executor.submit(path, dest, same_device, self.move_finished(run_id, n, category, operation, on_done))
+        del batch[:]
+
+    def move_finished(self, run_id, n, category, operation, on_done):
+        def finished(error):
+            if error is not None:
+                on_done(operation['filename'], category, None, error)
+                return
+            self.wal.done(run_id, n)
+            on_done(operation['filename'], category, operation, None)
+        return finished
+
+    # The run's history record has to be on disk before its write-ahead
+    # log records can be dropped
+    def finish_run(self, run_id):
+        if self.wal.written(run_id):
+            with self.history_lock:
+                self.journal.sync(force=True)
+        self.wal.end(run_id)
+
+    # Returns (action, target name) for a file whose name is already taken
+    # in its category folder. The action is 'move', 'replace', 'skip' or
+    # 'duplicate' (send it to Duplicates instead).
+    def resolve_conflict(self, entry, category, category_dir, names):
+        strategy = self.settings['conflicts']
+        filename = entry.name
+        if strategy == 'skip':
+            return 'skip', None
+
+        try:
+            st = entry.stat()
+            existing = os.stat(os.path.join(category_dir, filename))
+        except OSError:
+            # The other file is gone already or this one can't be read, so
+            # fall back to a name that can't clash
+            return 'move', unique_name(filename, names)
+
+        if strategy == 'overwrite-newer':
+            if st.st_mtime_ns > existing.st_mtime_ns:
+                return 'replace', filename
+            return 'skip', None
+
+        if strategy == 'dedupe':
+            if (st.st_size == existing.st_size and category != 'Duplicates' and
+                    self.content_hash(entry.path, st) == self.content_hash(os.path.join(category_dir, filename), existing)):
+                return 'duplicate', None
+        elif strategy == 'rename-hash':
+            digest = self.content_hash(entry.path, st)
+            if digest:
+                stem, ext = split_name(filename)
+                target = f"{stem}-{digest[:8]}{ext}"
+                if target not in names:
+                    return 'move', target
+
+        return 'move', unique_name(filename, names)
+
+    # Full content hash, shared with the dedupe stage through the cache
+    def content_hash(self, path, st):
+        digest = self.cache.get_hashes(st)[1]
+        if digest is None:
+            digest = DuplicateFinder(self.cache).hash_file(path, st.st_size, 'full')
+            if digest is not None:
+                self.cache.put_hashes(st, full=digest)
+        return digest
+
+    # Record stage: add a finished run to the history
+    def record(self, source, move_operations, total_files, metrics=None, wal_id=None):
+        if not move_operations:
+            return None
+
+        run = {
+            'timestamp': datetime.now().isoformat(),
+            'source': source,
+            'operations': move_operations,
+            'total_moved': len(move_operations),
+            'total_files': total_files
+        }
+        if metrics is not None:
+            run['metrics'] = metrics.summary()
+        if wal_id is not None:
+            # Lets recovery see that the run made it into the history
+            run['wal'] = wal_id
+        # Scheduled folders can finish at the same time
+        with self.history_lock:
+            # The journal only knows the next run id once it has been read
+            history = self.move_history
+            run = self.journal.append(run)
+            history.append(run)
+            self.trim_history()
+        return run
+
+    # Apply the retention policy and compact the journal when needed
+    def trim_history(self):
+        with self.history_lock:
+            self._trim_history()
+
+    def _trim_history(self):
+        expired = self.journal.expired_count(self.move_history)
+        if expired:
+            del self.move_history[:expired]
+            # Expired runs stay in the file as dead records until there are
+            # enough of them to be worth a rewrite
+            self.journal.dead_records += expired
+        if self.journal.needs_compaction(self.move_history):
+            self.journal.compact(self.move_history)
+
+    # Builds the on_done callback for flush_moves: collects the undo
+    # records and logs every move
+    def move_logger(self, move_operations, metrics, scheduled=False):
+        per_file = self.settings['log_detail'] == 'files'
+
+        def moved(filename, category, operation, error):
+            start = time.perf_counter()
+            if error is None:
+                move_operations.append(operation)
+
+                # Log the action
+                if per_file:
+                    fields = {'event': 'move', 'file': filename, 'category': category}
+                    if scheduled:
+                        logging.info(f"Scheduled move: {filename} -> {category}", extra={'fields': fields})
+                    else:
+                        logging.info(f"Moved: {filename} -> {category}", extra={'fields': fields})
+            else:
+                metrics.error(error)
+                fields = {'event': 'move_error', 'file': filename, 'category': category, 'error': str(error)}
+                if scheduled:
+                    logging.error(f"Error in scheduled move for {filename}: {str(error)}", extra={'fields': fields})
+                else:
+                    logging.error(f"Error moving {filename}: {str(error)}", extra={'fields': fields})
+            metrics.add_time('log', time.perf_counter() - start)
+
+        return moved
+
+    # With log_detail 'summary', one line per run instead of one per file
+    def log_summary(self, source, move_operations):
+        if self.settings['log_detail'] != 'summary' or not move_operations:
+            return
+        counts = {}
+        for operation in move_operations:
+            category = os.path.basename(operation['destination'])
+            counts[category] = counts.get(category, 0) + 1
+        text = ', '.join(f"{category} {count}" for category, count in sorted(counts.items()))
+        logging.info(f"Moved {len(move_operations)} files in {source}: {text}",
+                     extra={'fields': {'event': 'run_summary', 'source': source, 'categories': counts}})
+
+    # Scan, classify and dedupe stages: yields (entry, category) pairs
+    def classify_run(self, source, metrics, rules, names=None):
+        check = self.write_check(source)
+        if names is None and self.settings['recursive']:
+            classified = self.scan_tree(source, metrics, rules, check)
+        else:
+            entries = self.scan(source) if names is None else self.scan_names(source, names)
+            entries = metrics.timed_iter('scan', entries)
+            if check is not None:
+                entries = check.settled(entries)
+            classified = self.classified(entries, metrics, rules)
+        if self.settings['dedupe'] != 'off':
+            # Duplicates can only be found once the whole run is known, so
+            # this stage gives up streaming and classifies everything first
+            classified = list(classified)
+            planned = {entry.path: category for entry, category in classified}
+            with metrics.timer('dedupe'):
+                duplicates = self.find_duplicates(source, [entry for entry, _ in classified], planned)
+            for path, original in duplicates.items():
+                logging.info(f"Duplicate: {os.path.basename(path)} is identical to {original}")
+                if self.settings['dedupe'] == 'move':
+                    planned[path] = 'Duplicates'
+            classified = [(entry, planned[entry.path]) for entry, _ in classified]
+        if check is not None:
+            classified = self.held_back(source, check, classified, names)
+        return classified
+
+    # The write check for a run, or None when it is off
+    def write_check(self, source):
+        if not self.settings['quiet_seconds'] and not self.settings['check_open_files']:
+            return None
+        writing = open_for_writing(source) if self.settings['check_open_files'] else ()
+        return WriteCheck(self.snapshots.get(source, {}), self.settings['quiet_seconds'], writing)
+
+    # Passes the run's files through, then keeps the ones held back for the
+    # next run. A full scan replaces the folder's snapshot; a run over
+    # given names only updates theirs.
+    def held_back(self, source, check, classified, names):
+        try:
+            yield from classified
+        finally:
+            with self.history_lock:
+                if names is None:
+                    self.snapshots[source] = check.held
+                else:
+                    snapshot = self.snapshots.setdefault(source, {})
+                    for name in names:
+                        snapshot.pop(os.path.join(source, name), None)
+                    snapshot.update(check.held)
+            if check.held:
+                logging.info(f"Left {len(check.held)} files in {source} that may still be being written")
+
+    # Pass names to only look at those files instead of scanning the folder
+    def organize(self, source, progress=None, scheduled=False, names=None, cancel=None, rules=None, limits=None):
+        return self.at_run_priority(limits, lambda: self._organize(source, progress, scheduled, names, cancel,
+                                                                   rules, limits))
+
+    def _organize(self, source, progress, scheduled, names, cancel, rules, limits):
+        metrics = RunMetrics()
+        rules = rules or self.rules
+        rules.refresh()
+        total_files = 0
+        move_operations = []
+        ready_dirs = {}
+        source_device = os.stat(source).st_dev
+        moved = self.move_logger(move_operations, metrics, scheduled)
+        run_id = self.wal.begin('organize', source)
+        batch = []
+
+        # Unless the dedupe stage needed the full list, entries are classified
+        # and moved as the scan streams them (WAL_BATCH at a time), so the
+        # total is only known once the folder has been read to the end. The
+        # moves that did happen are recorded and the log's run is closed even
+        # if the run fails part way, so they can still be undone.
+        try:
+            with self.move_executor(metrics, cancel, limits) as executor:
+                for entry, category in self.classify_run(source, metrics, rules, names):
+                    if cancel is not None and cancel.is_set():
+                        logging.info("Organization cancelled")
+                        del batch[:]
+                        break
+
+                    total_files += 1
+
+                    try:
+                        self.move(executor, source, source_device, entry, category, ready_dirs, batch)
+                    except Exception as e:
+                        moved(entry.name, category, None, e)
+
+                    if len(batch) >= WAL_BATCH:
+                        self.flush_moves(executor, run_id, batch, moved)
+
+                    if progress:
+                        progress(total_files, None)
+
+                if batch:
+                    self.flush_moves(executor, run_id, batch, moved)
+        finally:
+            if metrics.counters['conflicts']:
+                self.cache.commit()
+            metrics.count('files_scanned', total_files)
+            metrics.count('files_moved', len(move_operations))
+            self.log_summary(source, move_operations)
+            with metrics.timer('save_state'):
+                self.record(source, move_operations, total_files, metrics, wal_id=run_id)
+                self.finish_run(run_id)
+            self.finish_metrics(metrics)
+        return len(move_operations), total_files
+
+    # Dry run: everything organize would do, as a plan that can be saved,
+    # compared and applied later. Nothing is created or moved.
+    def plan(self, source, progress=None, cancel=None, rules=None):
+        metrics = RunMetrics()
+        rules = rules or self.rules
+        rules.refresh()
+        listed = {}
+
+        def names_for(category_dir):
+            if category_dir not in listed:
+                try:
+                    listed[category_dir] = NameSet(os.listdir(category_dir))
+                except FileNotFoundError:
+                    listed[category_dir] = NameSet()
+            return listed[category_dir]
+
+        moves = []
+        for entry, category in self.classify_run(source, metrics, rules):
+            if cancel is not None and cancel.is_set():
+                logging.info("Planning cancelled")
+                break
+
+            try:
+                size = entry.stat().st_size
+                placed = self.place(source, entry, category, names_for, metrics)
+            except OSError as e:
+                logging.error(f"Error planning {entry.name}: {str(e)}")
+                continue
+            if placed is None:
+                continue
+
+            category, target, action = placed
+            move = {'source': entry.path, 'target': os.path.join(source, category, target),
+                    'size': size, 'category': category}
+            if action == 'replace':
+                move['replace'] = True
+            moves.append(move)
+
+            if progress:
+                progress(len(moves), None)
+
+        logging.info(f"Planned {len(moves)} moves in {source}")
+        return {'source': source, 'created': datetime.now().isoformat(), 'moves': moves}
+
+    # Carries out a plan, one destination folder at a time. Every folder is
+    # created before the first move. Files that have gone since the plan
+    # was made are logged as errors, and names that have been taken since
+    # then are resolved again with the current conflict setting.
+    def apply_plan(self, plan, progress=None, cancel=None):
+        return self.at_run_priority(None, lambda: self._apply_plan(plan, progress, cancel))
+
+    def _apply_plan(self, plan, progress, cancel):
+        metrics = RunMetrics()
+        source = plan['source']
+        moves = sorted(plan['moves'], key=lambda move: move['target'])
+        move_operations = []
+        ready_dirs = {}
+        source_device = os.stat(source).st_dev
+        moved = self.move_logger(move_operations, metrics)
+        batch = []
+
+        for category_dir in sorted({os.path.dirname(move['target']) for move in moves}):
+            self.ensure_dir(category_dir, ready_dirs, metrics)
+
+        def names_for(category_dir):
+            return self.ensure_dir(category_dir, ready_dirs, metrics)[1]
+
+        # As in organize, what was moved is recorded even if applying fails
+        run_id = self.wal.begin('organize', source)
+        try:
+            with self.move_executor(metrics, cancel) as executor:
+                for i, move in enumerate(moves):
+                    if cancel is not None and cancel.is_set():
+                        logging.info("Applying the plan cancelled")
+                        del batch[:]
+                        break
+
+                    category = move['category']
+                    target = os.path.basename(move['target'])
+                    action = 'replace' if move.get('replace') else 'move'
+                    try:
+                        names = names_for(os.path.dirname(move['target']))
+                        if action == 'move' and target in names:
+                            entry = FileEntry(os.path.dirname(move['source']), os.path.basename(move['source']))
+                            placed = self.place(source, entry, category, names_for, metrics)
+                            if placed is None:
+                                continue
+                            category, target, action = placed
+                        else:
+                            names.add(target)
+                        batch.append(self.prepare_move(executor, source, source_device, move['source'], category,
+                                                       target, action, ready_dirs))
+                    except Exception as e:
+                        moved(os.path.basename(move['source']), category, None, e)
+
+                    if len(batch) >= WAL_BATCH:
+                        self.flush_moves(executor, run_id, batch, moved)
+
+                    if progress:
+                        progress(i + 1, len(moves))
+
+                if batch:
+                    self.flush_moves(executor, run_id, batch, moved)
+        finally:
+            if metrics.counters['conflicts']:
+                self.cache.commit()
+            metrics.count('files_scanned', len(moves))
+            metrics.count('files_moved', len(move_operations))
+            self.log_summary(source, move_operations)
+            with metrics.timer('save_state'):
+                self.record(source, move_operations, len(moves), metrics, wal_id=run_id)
+                self.finish_run(run_id)
+            self.finish_metrics(metrics)
+        return len(move_operations), len(moves)
+
+    # Keep the run's metrics for callers and export the running totals
+    def finish_metrics(self, metrics):
+        metrics.finish()
+        with self.history_lock:
+            self.last_metrics = metrics
+            self.total_metrics.merge(metrics)
+
+            metrics_file = self.settings['metrics_file']
+            if metrics_file:
+                try:
+                    tmp_path = metrics_file + '.tmp'
+                    with open(tmp_path, 'w') as f:
+                        f.write(self.total_metrics.prometheus())
+                    os.replace(tmp_path, metrics_file)
+                except OSError as e:
+                    logging.error(f"Error writing metrics to {metrics_file}: {str(e)}")
+
+    # Dedupe stage: compare this run's files with each other and with the
+    # files already organized into the categories they are headed for.
+    # Only existing files with the size of a new one can be a duplicate, so
+    # only those are stat'ed and hashed.
+    def find_duplicates(self, source, entries, planned):
+        files = []
+        for entry in entries:
+            try:
+                files.append((entry.path, entry.stat(), True))
+            except OSError:
+                continue
+        sizes = {st.st_size for _, st, _ in files if st.st_size}
+
+        for category in set(planned.values()):
+            category_dir = os.path.join(source, category)
+            for name, size in self.folder_sizes(category_dir).items():
+                if size not in sizes:
+                    continue
+                path = os.path.join(category_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if S_ISREG(st.st_mode) and st.st_size in sizes:
+                    files.append((path, st, False))
+
+        return DuplicateFinder(self.cache, self.settings['move_workers']).find(files)
+
+    # Returns {name: size} for the files in a category folder. The index is
+    # kept in the cache and is only refreshed when the folder's mtime
+    # changes, and then only names that weren't there before are stat'ed,
+    # so a big category folder costs a readdir at most instead of a stat
+    # per file. A file rewritten in place keeps its old size here, which
+    # can only hide a duplicate, never report a wrong one.
+    def folder_sizes(self, category_dir):
+        try:
+            # Read before the folder, so changes during the scan show up as
+            # a newer mtime next time
+            mtime_ns = os.stat(category_dir).st_mtime_ns
+        except OSError:
+            return {}
+        indexed_mtime, indexed = self.cache.get_folder_sizes(category_dir)
+        if indexed_mtime == mtime_ns:
+            return indexed
+
+        sizes = {}
+        try:
+            with os.scandir(category_dir) as existing:
+                for entry in existing:
+                    if entry.name in indexed:
+                        sizes[entry.name] = indexed[entry.name]
+                        continue
+                    try:
+                        if entry.is_file():
+                            sizes[entry.name] = entry.stat().st_size
+                    except OSError:
+                        continue
+        except OSError:
+            return {}
+        self.cache.put_folder_sizes(category_dir, mtime_ns, sizes)
+        return sizes
+
+    # Runs one organize through the job queue and waits for it, so watcher
+    # batches take turns with manual and scheduled runs of the same folder
+    def run_job(self, source, **kwargs):
+        return self.jobs.submit(lambda: self.organize(source, **kwargs), folder=source).result()
+
+    # Organize the folder once, then keep organizing files as they arrive.
+    # Events are collected until the folder has been quiet for `debounce`
+    # seconds (or max_batch names are waiting) and then moved as one run.
+    def watch(self, source, stop_event, debounce=0.5, max_batch=1000, on_batch=None):
+        result = self.run_job(source, scheduled=True)
+        if on_batch:
+            on_batch(result)
+
+        watcher = open_watcher(source)
+        logging.info(f"Watching {source} for new files ({type(watcher).__name__})")
+        pending = set()
+        last_event = 0
+        last_retry = time.monotonic()
+
+        try:
+            while not stop_event.is_set():
+                names = watcher.wait(debounce)
+                now = time.monotonic()
+
+                if names is None:
+                    # Events were lost, so fall back to one full scan
+                    pending.clear()
+                    result = self.run_job(source, scheduled=True)
+                elif names:
+                    pending.update(names)
+                    last_event = now
+                    if len(pending) < max_batch:
+                        continue
+                    result = self.run_job(source, scheduled=True, names=pending)
+                    pending = set()
+                elif pending and now - last_event >= debounce:
+                    result = self.run_job(source, scheduled=True, names=pending)
+                    pending = set()
+                elif self.snapshots.get(source) and now - last_retry >= max(self.settings['quiet_seconds'], 5):
+                    # Files the write check held back send no more events
+                    # once they are finished, so they are looked at again
+                    last_retry = now
+                    held = {os.path.relpath(path, source) for path in self.snapshots[source]}
+                    held = {name for name in held if os.sep not in name}
+                    if not held:
+                        continue
+                    result = self.run_job(source, scheduled=True, names=held)
+                else:
+                    continue
+
+                if on_batch:
+                    on_batch(result)
+        finally:
+            watcher.close()
+            logging.info(f"Stopped watching {source}")
+
+    def undo_last(self, progress=None, cancel=None):
+        return self.undo_run(progress=progress, cancel=cancel)
+
+    def history_run(self, run_id):
+        with self.history_lock:
+            return next((run for run in self.move_history if run['id'] == run_id), None)
+
+    # The moves of a history run. Holds the history lock so another run
+    # can't compact the journal or append to it during the read.
+    def run_operations(self, run):
+        with self.history_lock:
+            return self.journal.operations(run)
+
+    # Keeps only `operations` of a run in the history, or drops the run if
+    # none are left
+    def set_run_operations(self, run, operations):
+        with self.history_lock:
+            if run not in self.move_history:
+                return
+            index = self.move_history.index(run)
+            if operations:
+                self.move_history[index] = self.journal.replace(run, operations)
+            else:
+                del self.move_history[index]
+                self.journal.append_undo(run)
+
+    # Works out what undoing a run (or the part of it in `categories` and
+    # matching `pattern`) would do, with one listing per folder involved.
+    # Returns the run's operations and the selected ones split into
+    # 'restore', 'missing' (no longer where they were moved to) and
+    # 'conflicts' (the original name is taken again).
+    def check_undo(self, run, categories=None, pattern=None):
+        operations = self.run_operations(run)
+        selected = [operation for operation in operations
+                    if (not categories or os.path.basename(operation['destination']) in categories)
+                    and (not pattern or fnmatch.fnmatch(operation['filename'], pattern))]
+        listings = {}
+
+        def names_in(directory):
+            if directory not in listings:
+                try:
+                    listings[directory] = set(os.listdir(directory))
+                except FileNotFoundError:
+                    listings[directory] = set()
+            return listings[directory]
+
+        check = {'operations': operations, 'restore': [], 'missing': [], 'conflicts': []}
+        restoring = set()
+        for operation in selected:
+            current, original = undo_paths(operation)
+            if os.path.basename(current) not in names_in(operation['destination']):
+                check['missing'].append(operation)
+            elif operation['filename'] in names_in(operation['source']) or original in restoring:
+                check['conflicts'].append(operation)
+            else:
+                check['restore'].append(operation)
+                restoring.add(original)
+        return check
+
+    # Undo a run (the last one by default), or only its files in
+    # `categories` and matching `pattern`. Files whose names are taken again
+    # are left where they are and stay undoable. Restores go through the
+    # move executor, so they are renames where possible.
+    def undo_run(self, run_id=None, categories=None, pattern=None, progress=None, cancel=None):
+        return self.at_run_priority(None, lambda: self._undo_run(run_id, categories, pattern, progress, cancel))
+
+    def _undo_run(self, run_id, categories, pattern, progress, cancel):
+        with self.history_lock:
+            if not self.move_history:
+                return None
+            run = self.move_history[-1] if run_id is None else self.history_run(run_id)
+        if run is None:
+            return None
+
+        check = self.check_undo(run, categories, pattern)
+        restore = check['restore']
+        total_operations = len(restore) + len(check['missing']) + len(check['conflicts'])
+        for operation in check['conflicts']:
+            logging.error(f"Undo: {operation['filename']} not restored, the name is taken in {operation['source']}")
+
+        restored = []
+        devices = {}
+
+        def device(directory):
+            if directory not in devices:
+                os.makedirs(directory, exist_ok=True)
+                devices[directory] = os.stat(directory).st_dev
+            return devices[directory]
+
+        def finished(n, operation):
+            def done(error):
+                if error is not None:
+                    logging.error(f"Error during undo for {operation['filename']}: {str(error)}")
+                else:
+                    self.wal.done(run_id, n)
+                    restored.append(operation)
+                    logging.info(f"Undo: Moved {operation['filename']} back to original location")
+                if progress:
+                    progress(len(restored), len(restore))
+            return done
+
+        # Every restore is logged up front with one fsync, so a crash part
+        # way through can be finished on restart. The files restored before
+        # a failure still leave the history and the log's run is closed.
+        run_id = self.wal.begin('undo', run['source'], history_id=run['id'], total_files=run['total_files'])
+        try:
+            numbers = [self.wal.intent(run_id, *undo_paths(operation), operation) for operation in restore]
+            self.wal.commit()
+
+            with self.move_executor(cancel=cancel) as executor:
+                for n, operation in zip(numbers, restore):
+                    if cancel is not None and cancel.is_set():
+                        # The files that weren't restored stay undoable
+                        logging.info("Undo cancelled")
+                        break
+
+                    current, original = undo_paths(operation)
+                    try:
+                        same_device = device(operation['destination']) == device(operation['source'])
+                    except OSError as e:
+                        logging.error(f"Error during undo for {operation['filename']}: {str(e)}")
+                        continue
+                    executor.submit(current, original, same_device, finished(n, operation))
+        finally:
+            # Files that are gone can't be undone later either, so they leave
+            # the history along with the restored ones
+            gone = {undo_key(operation) for operation in restored + check['missing']}
+            self.set_run_operations(run, [operation for operation in check['operations'] if undo_key(operation) not in gone])
+            self.finish_run(run_id)
+            self.trim_history()
+        return len(restored), total_operations
+
+    # Finishes (mode 'resume') or reverses (mode 'rollback') the runs the
+    # write-ahead log shows were cut short. Returns the number of runs.
+    def recover(self, mode='resume'):
+        interrupted = list(self.wal.interrupted)
+        for run in interrupted:
+            logging.info(f"Recovering an interrupted {run['kind']} run in {run['source']} ({mode})")
+            try:
+                if run['kind'] == 'undo':
+                    self.recover_undo(run, mode)
+                else:
+                    self.recover_organize(run, mode)
+            except Exception as e:
+                logging.error(f"Error recovering the run in {run['source']}: {str(e)}")
+            self.wal.resolved(run)
+        return len(interrupted)
+
+    # Splits a logged run's moves into those that happened and those that
+    # didn't. A move whose completion wasn't logged counts as done if its
+    # file is at the target and gone from where it started.
+    @staticmethod
+    def split_moves(run):
+        completed, remaining = [], []
+        for n, move in sorted(run['moves'].items()):
+            if n in run['done'] or (os.path.lexists(move['to']) and not os.path.lexists(move['from'])):
+                completed.append(move)
+            else:
+                remaining.append(move)
+                # A copy to another filesystem cut short leaves its partial file
+                try:
+                    os.unlink(partial_path(move['to']))
+                except OSError:
+                    pass
+        return completed, remaining
+
+    def recover_organize(self, run, mode):
+        if any(history.get('wal') == run['begin'] for history in self.move_history):
+            # Only the end record was lost
+            return
+
+        completed, remaining = self.split_moves(run)
+        if mode == 'rollback':
+            for move in reversed(completed):
+                recover_move(move['to'], move['from'], "Rollback")
+            return
+
+        for move in remaining:
+            if os.path.exists(move['from']) and (move['op'].get('replaced') or not os.path.lexists(move['to'])):
+                os.makedirs(os.path.dirname(move['to']), exist_ok=True)
+                if recover_move(move['from'], move['to'], "Resume"):
+                    completed.append(move)
+        self.record(run['source'], [move['op'] for move in completed], len(run['moves']))
+
+    def recover_undo(self, run, mode):
+        completed, remaining = self.split_moves(run)
+        logged = [move['op'] for move in sorted_moves(run)]
+        history = self.history_run(run['history_id'])
+
+        if mode == 'rollback':
+            # Put the restored files back and make them undoable again
+            for move in reversed(completed):
+                recover_move(move['to'], move['from'], "Rollback")
+            if history is None:
+                self.record(run['source'], logged, run['total_files'])
+            else:
+                current = self.run_operations(history)
+                kept = {undo_key(operation) for operation in current}
+                self.set_run_operations(history, current + [op for op in logged if undo_key(op) not in kept])
+            return
+
+        for move in remaining:
+            if os.path.exists(move['from']):
+                recover_move(move['from'], move['to'], "Resume undo")
+        if history is not None:
+            # The crash came before the history was updated
+            undone = {undo_key(operation) for operation in logged}
+            self.set_run_operations(history, [operation for operation in self.run_operations(history)
+                                              if undo_key(operation) not in undone])
+
+    # Only the settings are saved here; the history is written to the
+    # journal as each run finishes
+    def save_state(self):
+        with self.history_lock:
+            tmp_path = self.state_file + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.settings, f)
+            os.replace(tmp_path, self.state_file)
+
+    def load_state(self):
+        state = {}
+        try:
+            if os.path.exists(self.state_file):
+                with open(self.state_file, 'r') as f:
+                    state = json.load(f)
+
+                for key, default in DEFAULT_SETTINGS.items():
+                    self.settings[key] = state.get(key, copy.deepcopy(default))
+
+        except Exception as e:
+            print(f"Error loading state: {str(e)}")
+
+        self.jobs.max_workers = self.settings['scheduler_workers']
+        self.journal.max_runs = self.settings['history_max_runs']
+        try:
+            self.wal.load()
+        except Exception as e:
+            logging.error(f"Error reading {self.wal.path}: {str(e)}")
+        self.journal.max_age_days = self.settings['history_max_days']
+
+        # The history itself is loaded when first used. Older versions kept
+        # the whole history inside the state file; that is moved into the
+        # journal once and dropped from the state.
+        if 'move_history' in state:
+            try:
+                if not self.move_history:
+                    self.move_history = [self.journal.append(run) for run in state['move_history']]
+                self.save_state()
+            except Exception as e:
+                print(f"Error loading history: {str(e)}")
+
+    def close(self):
+        self.jobs.close()
+        self.journal.close()
+        self.wal.close()
+        if self.sniffer is not None:
+            self.sniffer.close()
+        self.cache.close()
+
+
+class FolderScheduler:
+    # Scheduled organization for any number of folders, each with its own
+    # interval and optional rules file. Due folders go into the engine's job
+    # queue, so they run side by side but never overlap a manual run of the
+    # same folder, and a folder that keeps turning up nothing is checked
+    # less often (up to max_backoff times its interval).
+    def __init__(self, engine, max_backoff=8, on_start=None, on_done=None):
+        self.engine = engine
+        self.max_backoff = max(1, max_backoff)
+        self.on_start = on_start
+        self.on_done = on_done
+        lazy_import(schedule='schedule')
+        self.scheduler = schedule.Scheduler()
+        self.folders = []
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def add_folder(self, path, minutes, rules_file=None, limits=None):
+        folder = {'path': path, 'minutes': minutes, 'rules_file': rules_file, 'limits': limits, 'idle_runs': 0}
+        folder['job'] = self.scheduler.every(minutes).minutes.do(self.dispatch, folder)
+        self.folders.append(folder)
+        return folder
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        while not self.stop_event.is_set():
+            self.scheduler.run_pending()
+            self.stop_event.wait(1)
+
+    def stop(self):
+        self.stop_event.set()
+        self.scheduler.clear()
+
+    def dispatch(self, folder):
+        # Runs on the scheduler thread, so it only queues the folder. If a
+        # run of it is already waiting this one is merged into it.
+        path = folder['path']
+        self.engine.jobs.submit(
+            lambda: self.run_folder(folder),
+            folder=path,
+            key=('organize', path),
+            on_done=lambda result, error: self.finished(folder, result, error)
+        )
+
+    def run_folder(self, folder):
+        path = folder['path']
+        logging.info(f"Scheduled organization started: {path}")
+        if self.on_start:
+            self.on_start(path)
+        return self.engine.organize(path, scheduled=True, rules=self.engine.rules_for(folder['rules_file']),
+                                    limits=folder['limits'])
+
+    def finished(self, folder, result, error):
+        path = folder['path']
+        if error is not None:
+            logging.error(f"Error in scheduled organization of {path}: {str(error)}")
+        elif result[1] == 0:
+            logging.info(f"Scheduled organization: No files to organize in {path}")
+        else:
+            logging.info(f"Scheduled organization complete: {result[0]} files moved in {path}")
+
+        self.backoff(folder, result)
+        if self.on_done:
+            self.on_done(path, result, error)
+
+    def backoff(self, folder, result):
+        if result and result[1]:
+            folder['idle_runs'] = 0
+        else:
+            folder['idle_runs'] += 1
+
+        # Double the wait for every idle run in a row, and go straight back
+        # to the normal interval as soon as files turn up
+        job = folder['job']
+        job.interval = folder['minutes'] * min(2 ** folder['idle_runs'], self.max_backoff)
+        job.next_run = datetime.now() + timedelta(minutes=job.interval)
+
 
 class FileOrganizer:
-    def __init__(self):
-        # Define file categories and their extensions
-        self.categories = {
-            'Images': ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.svg', '.webp'],
-            'Videos': ['.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.webm', '.m4v'],
-            'Documents': ['.pdf', '.docx', '.doc', '.txt', '.xlsx', '.pptx', '.csv', '.rtf', '.odt'],
-            'Music': ['.mp3', '.wav', '.flac', '.aac', '.ogg', '.wma', '.m4a'],
-            'Archives': ['.zip', '.rar', '.7z', '.tar', '.gz', '.bz2'],
-            'Code': ['.py', '.js', '.html', '.css', '.java', '.cpp', '.c', '.php', '.rb', '.json', '.xml'],
-            'Executables': ['.exe', '.msi', '.bat', '.sh', '.deb', '.rpm'],
-            'Others': []  # For any other file types
-        }
+    def __init__(self, engine=None):
+        lazy_import(tk='tkinter', filedialog='tkinter.filedialog', messagebox='tkinter.messagebox',
+                    ttk='tkinter.ttk', scrolledtext='tkinter.scrolledtext')
+        self.engine = engine or OrganizerEngine()
+        self.categories = self.engine.categories
         
         # Create the main application window
         self.root = tk.Tk()
@@ -33,15 +3441,34 @@ class FileOrganizer:
         # Variables
         self.source_path = tk.StringVar()
         self.schedule_minutes = tk.IntVar(value=5)
+        self.watch_mode = tk.BooleanVar(value=False)
+        self.dedupe_mode = tk.StringVar(value='off')
+        self.sniff_mode = tk.StringVar(value='fill')
+        self.conflict_mode = tk.StringVar(value='rename')
+        self.log_detail = tk.StringVar(value='files')
+        self.recursive = tk.BooleanVar(value=False)
         self.organizing = False
         self.scheduler_running = False
         self.scheduler_thread = None
-        self.move_history = []
+        self.folder_scheduler = None
+        self.watch_stop = threading.Event()
+        self.cancel_event = threading.Event()
+        self.events = queue.Queue()
+        self.last_progress_post = 0
+        self.last_plan = None
+        self.log_tail = LogTail(LOG_FILE)
+        self.log_page = None  # None while following the end of the log
+        self.log_filter = tk.StringVar()
+        self.history_page = 0
+        self.history_rows = []
         
         # Load previous state if available
         self.load_state()
         
         self.setup_ui()
+        self.recover_interrupted()
+        self.root.after_idle(self.load_history)
+        self.root.after(UI_REFRESH_MS, self.drain_events)
         
     def setup_ui(self):
         # Create notebook for tabs
@@ -191,6 +3618,20 @@ class FileOrganizer:
         )
         self.organize_btn.pack(side='left', padx=5)
         
+        # Preview button
+        self.preview_btn = tk.Button(
+            button_frame,
+            text="Preview",
+            command=self.preview_organization,
+            bg='#3498db',
+            fg='white',
+            font=("Arial", 10, "bold"),
+            relief='flat',
+            padx=15,
+            pady=8
+        )
+        self.preview_btn.pack(side='left', padx=5)
+        
         # Undo button
         self.undo_btn = tk.Button(
             button_frame,
@@ -206,6 +3647,21 @@ class FileOrganizer:
         )
         self.undo_btn.pack(side='left', padx=5)
         
+        # Cancel button
+        self.cancel_btn = tk.Button(
+            button_frame,
+            text="Cancel",
+            command=self.cancel_work,
+            bg='#95a5a6',
+            fg='white',
+            font=("Arial", 10, "bold"),
+            relief='flat',
+            padx=15,
+            pady=8,
+            state='disabled'
+        )
+        self.cancel_btn.pack(side='left', padx=5)
+        
         # Progress bar
         self.progress = ttk.Progressbar(
             parent,
@@ -267,6 +3723,112 @@ class FileOrganizer:
             fg='#34495e'
         ).pack(side='left', padx=5)
         
+        tk.Checkbutton(
+            scheduler_frame,
+            text="Watch the folder and organize new files as they arrive",
+            variable=self.watch_mode,
+            font=("Arial", 10),
+            bg='#f5f5f5',
+            fg='#34495e'
+        ).pack(anchor='w', pady=5)
+        
+        # Duplicate handling
+        dedupe_frame = tk.Frame(scheduler_frame, bg='#f5f5f5')
+        dedupe_frame.pack(fill='x', pady=5)
+        
+        tk.Label(
+            dedupe_frame,
+            text="Duplicate files:",
+            font=("Arial", 10),
+            bg='#f5f5f5',
+            fg='#34495e'
+        ).pack(side='left')
+        
+        tk.OptionMenu(dedupe_frame, self.dedupe_mode, 'off', 'report', 'move').pack(side='left', padx=5)
+        
+        tk.Label(
+            dedupe_frame,
+            text="Check file contents:",
+            font=("Arial", 10),
+            bg='#f5f5f5',
+            fg='#34495e'
+        ).pack(side='left', padx=(15, 0))
+        
+        tk.OptionMenu(dedupe_frame, self.sniff_mode, 'off', 'fill', 'override').pack(side='left', padx=5)
+        
+        conflict_frame = tk.Frame(scheduler_frame, bg='#f5f5f5')
+        conflict_frame.pack(fill='x', pady=5)
+        
+        tk.Label(
+            conflict_frame,
+            text="If the name is taken:",
+            font=("Arial", 10),
+            bg='#f5f5f5',
+            fg='#34495e'
+        ).pack(side='left')
+        
+        tk.OptionMenu(
+            conflict_frame, self.conflict_mode, 'skip', 'rename', 'rename-hash', 'overwrite-newer', 'dedupe'
+        ).pack(side='left', padx=5)
+        
+        tk.Label(
+            conflict_frame,
+            text="Log:",
+            font=("Arial", 10),
+            bg='#f5f5f5',
+            fg='#34495e'
+        ).pack(side='left', padx=(15, 0))
+        
+        tk.OptionMenu(conflict_frame, self.log_detail, 'files', 'summary').pack(side='left', padx=5)
+        
+        tk.Checkbutton(
+            conflict_frame,
+            text="Include subfolders",
+            variable=self.recursive,
+            font=("Arial", 10),
+            bg='#f5f5f5',
+            fg='#34495e'
+        ).pack(side='left', padx=(15, 0))
+        
+        # Other folders the scheduler looks after, each on its own interval
+        tk.Label(
+            scheduler_frame,
+            text="Other scheduled folders:",
+            font=("Arial", 10),
+            bg='#f5f5f5',
+            fg='#34495e'
+        ).pack(anchor='w', pady=(10, 0))
+        
+        folders_frame = tk.Frame(scheduler_frame, bg='#f5f5f5')
+        folders_frame.pack(fill='x', pady=5)
+        
+        self.folders_listbox = tk.Listbox(
+            folders_frame,
+            font=("Arial", 9),
+            height=4
+        )
+        self.folders_listbox.pack(side='left', fill='x', expand=True)
+        
+        tk.Button(
+            folders_frame,
+            text="Add...",
+            command=self.add_scheduled_folder,
+            font=("Arial", 9),
+            relief='flat',
+            padx=10
+        ).pack(side='left', padx=5)
+        
+        tk.Button(
+            folders_frame,
+            text="Remove",
+            command=self.remove_scheduled_folder,
+            font=("Arial", 9),
+            relief='flat',
+            padx=10
+        ).pack(side='left')
+        
+        self.update_folders_listbox()
+        
         # Scheduler buttons frame
         scheduler_btn_frame = tk.Frame(scheduler_frame, bg='#f5f5f5')
         scheduler_btn_frame.pack(pady=10, fill='x')
@@ -326,8 +3888,48 @@ class FileOrganizer:
         )
         self.history_listbox.pack(fill='both', expand=True, padx=5, pady=5)
         
-        # Populate history
-        self.update_history_listbox()
+        # Only one page of runs is in the listbox at a time
+        history_nav = tk.Frame(history_frame, bg='#f5f5f5')
+        history_nav.pack(fill='x', padx=5, pady=(0, 5))
+        
+        tk.Button(
+            history_nav,
+            text="Newer",
+            command=lambda: self.show_history_page(self.history_page - 1),
+            font=("Arial", 9),
+            relief='flat',
+            padx=10
+        ).pack(side='left')
+        
+        tk.Button(
+            history_nav,
+            text="Older",
+            command=lambda: self.show_history_page(self.history_page + 1),
+            font=("Arial", 9),
+            relief='flat',
+            padx=10
+        ).pack(side='left', padx=5)
+        
+        self.history_position = tk.Label(
+            history_nav,
+            text="",
+            font=("Arial", 9),
+            bg='#f5f5f5',
+            fg='#7f8c8d'
+        )
+        self.history_position.pack(side='left', padx=5)
+        
+        tk.Button(
+            history_nav,
+            text="Undo Selected...",
+            command=self.undo_selected_run,
+            font=("Arial", 9),
+            relief='flat',
+            padx=10
+        ).pack(side='right')
+        
+        # Filled in by history_ready once the history has been read
+        self.history_listbox.insert(tk.END, "Loading history...")
         
     def build_log_tab(self, parent):
         # Header
@@ -340,218 +3942,573 @@ class FileOrganizer:
         )
         header.pack(pady=10)
         
+        # Search box
+        search_frame = tk.Frame(parent, bg='#f5f5f5')
+        search_frame.pack(padx=10, fill='x')
+        
+        tk.Label(
+            search_frame,
+            text="Search:",
+            font=("Arial", 10),
+            bg='#f5f5f5',
+            fg='#34495e'
+        ).pack(side='left')
+        
+        search_entry = tk.Entry(
+            search_frame,
+            textvariable=self.log_filter,
+            font=("Arial", 10)
+        )
+        search_entry.pack(side='left', fill='x', expand=True, padx=5)
+        search_entry.bind('<Return>', lambda event: self.search_log())
+        
+        tk.Button(
+            search_frame,
+            text="Search",
+            command=self.search_log,
+            font=("Arial", 9),
+            relief='flat',
+            padx=10
+        ).pack(side='left')
+        
         # Log text area
         log_text_frame = tk.Frame(parent, bg='#f5f5f5')
         log_text_frame.pack(pady=10, padx=10, fill='both', expand=True)
         
-        self.log_text = scrolledtext.ScrolledText(
-            log_text_frame,
-            wrap=tk.WORD,
-            width=70,
-            height=20,
-            font=("Consolas", 9)
-        )
-        self.log_text.pack(fill='both', expand=True)
-        self.log_text.config(state='disabled')
+        self.log_text = scrolledtext.ScrolledText(
+            log_text_frame,
+            wrap=tk.WORD,
+            width=70,
+            height=20,
+            font=("Consolas", 9)
+        )
+        self.log_text.pack(fill='both', expand=True)
+        self.log_text.config(state='disabled')
+        
+        # Log buttons frame
+        log_btn_frame = tk.Frame(parent, bg='#f5f5f5')
+        log_btn_frame.pack(pady=10, fill='x')
+        
+        tk.Button(
+            log_btn_frame,
+            text="Refresh Log",
+            command=self.refresh_log_display,
+            bg='#3498db',
+            fg='white',
+            font=("Arial", 10, "bold"),
+            relief='flat',
+            padx=15,
+            pady=5
+        ).pack(side='left', padx=5)
+        
+        tk.Button(
+            log_btn_frame,
+            text="Clear Log",
+            command=self.clear_log,
+            bg='#e74c3c',
+            fg='white',
+            font=("Arial", 10, "bold"),
+            relief='flat',
+            padx=15,
+            pady=5
+        ).pack(side='left', padx=5)
+        
+        tk.Button(
+            log_btn_frame,
+            text="Open Log File",
+            command=self.view_log_file,
+            bg='#2ecc71',
+            fg='white',
+            font=("Arial", 10, "bold"),
+            relief='flat',
+            padx=15,
+            pady=5
+        ).pack(side='left', padx=5)
+        
+        # Paging through older lines
+        for text, command in (("Older", self.older_log_page), ("Newer", self.newer_log_page),
+                              ("Latest", self.latest_log)):
+            tk.Button(
+                log_btn_frame,
+                text=text,
+                command=command,
+                font=("Arial", 9),
+                relief='flat',
+                padx=10
+            ).pack(side='left', padx=2)
+            
+        self.log_position = tk.Label(
+            log_btn_frame,
+            text="",
+            font=("Arial", 9),
+            bg='#f5f5f5',
+            fg='#7f8c8d'
+        )
+        self.log_position.pack(side='left', padx=5)
+        
+        # Refresh log display initially
+        self.refresh_log_display()
+        
+    def browse_folder(self):
+        folder_selected = filedialog.askdirectory()
+        if folder_selected:
+            self.source_path.set(folder_selected)
+            self.status.config(text="Ready to organize files")
+            
+    def organize_files(self):
+        if self.organizing:
+            return
+            
+        source = self.source_path.get()
+        if not source:
+            messagebox.showerror("Error", "Please select a folder first")
+            return
+            
+        self.organizing = True
+        self.organize_btn.config(state='disabled', text="Organizing...")
+        self.undo_btn.config(state='disabled')
+        self.status.config(text="Organizing files...")
+        self.sync_settings()
+        
+        self.run_in_background(
+            lambda: self.engine.organize(source, progress=self.post_progress, cancel=self.cancel_event),
+            self.organize_done,
+            folder=source,
+            key=('organize', source)
+        )
+        
+    def organize_done(self, result, error):
+        try:
+            if error is not None:
+                messagebox.showerror("Error", f"An error occurred: {str(error)}")
+                logging.error(f"Organization error: {str(error)}")
+                self.status.config(text="Error occurred during organization")
+                return
+                
+            moved_count, total_files = result
+            if total_files == 0:
+                messagebox.showinfo("Info", "No files found to organize")
+                self.status.config(text="No files found to organize")
+                return
+                
+            if moved_count:
+                self.update_history_listbox()
+            
+            # Show completion message
+            if self.cancel_event.is_set():
+                messagebox.showinfo("Cancelled", f"Cancelled after organizing {moved_count} of {total_files} files")
+            else:
+                messagebox.showinfo("Complete", f"Organized {moved_count} of {total_files} files")
+            self.status.config(text=f"Organized {moved_count} of {total_files} files")
+            
+        finally:
+            self.organizing = False
+            self.organize_btn.config(state='normal', text="Organize Files")
+            if self.engine.move_history:
+                self.undo_btn.config(state='normal')
+            self.progress.config(mode='determinate')
+            self.progress['value'] = 0
+            self.refresh_log_display()
+            
+    # Queues work() on the engine's job queue and calls on_done(result,
+    # error) back on the Tk thread. Progress from the worker arrives through
+    # self.events and is drawn by drain_events at a fixed rate, however fast
+    # files are moved.
+    def run_in_background(self, work, on_done, folder=None, key=None):
+        self.cancel_event.clear()
+        self.cancel_btn.config(state='normal')
+        
+        self.engine.jobs.submit(
+            work,
+            folder=folder,
+            key=key,
+            on_done=lambda result, error: self.events.put(('done', on_done, result, error))
+        )
+        
+    # Runs fn() on the Tk thread. Worker threads never call Tk themselves:
+    # closing the window joins them on the Tk thread, and a worker waiting
+    # for Tk then would never finish.
+    def on_tk_thread(self, fn):
+        self.events.put(('call', fn))
+        
+    def post_progress(self, done, total):
+        # Called on the worker thread for every file, so only queue an event
+        # when the UI is due to redraw anyway
+        now = time.monotonic()
+        if now - self.last_progress_post >= UI_REFRESH_MS / 1000:
+            self.last_progress_post = now
+            self.events.put(('progress', done, total))
+            
+    # Runs on the Tk thread every UI_REFRESH_MS while the window is open
+    def drain_events(self):
+        # Only the newest progress event is drawn; older ones are dropped
+        progress = None
+        calls = []
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == 'progress':
+                progress = event[1:]
+            else:
+                calls.append(event)
+                
+        if progress:
+            self.show_progress(*progress)
+            
+        for event in calls:
+            try:
+                if event[0] == 'done':
+                    self.cancel_btn.config(state='disabled')
+                    on_done, result, error = event[1:]
+                    on_done(result, error)
+                else:
+                    event[1]()
+            except Exception as e:
+                logging.error(f"Error updating the window: {str(e)}")
+        self.root.after(UI_REFRESH_MS, self.drain_events)
+            
+    def cancel_work(self):
+        self.cancel_event.set()
+        self.cancel_btn.config(state='disabled')
+        self.status.config(text="Cancelling...")
+        
+    def show_progress(self, done, total):
+        if total is None:
+            # Streaming scan: the total isn't known until the folder is read
+            self.progress.config(mode='indeterminate')
+            self.progress.step()
+            self.status.config(text=f"Processed {done} files")
+        else:
+            self.progress.config(mode='determinate', maximum=total)
+            self.progress['value'] = done
+            self.status.config(text=f"Processed {done} of {total} files")
+        
+    def preview_organization(self):
+        if self.organizing:
+            return
+            
+        source = self.source_path.get()
+        if not source:
+            messagebox.showerror("Error", "Please select a folder first")
+            return
+            
+        self.organizing = True
+        self.organize_btn.config(state='disabled')
+        self.preview_btn.config(state='disabled')
+        self.status.config(text="Planning...")
+        self.sync_settings()
+        
+        self.run_in_background(
+            lambda: self.engine.plan(source, progress=self.post_progress, cancel=self.cancel_event),
+            self.preview_done,
+            folder=source,
+            key=('plan', source)
+        )
+        
+    def preview_done(self, plan, error):
+        self.organizing = False
+        self.organize_btn.config(state='normal')
+        self.preview_btn.config(state='normal')
+        self.progress.config(mode='determinate')
+        self.progress['value'] = 0
+        self.refresh_log_display()
+        
+        if error is not None:
+            messagebox.showerror("Error", f"An error occurred while planning: {str(error)}")
+            logging.error(f"Planning error: {str(error)}")
+            self.status.config(text="Error occurred while planning")
+            return
+            
+        previous = self.last_plan if self.last_plan and self.last_plan['source'] == plan['source'] else None
+        self.last_plan = plan
+        self.status.config(text=f"Planned {len(plan['moves'])} moves")
+        self.show_plan(plan, previous)
+        
+    def show_plan(self, plan, previous=None):
+        window = tk.Toplevel(self.root)
+        window.title("Organization Preview")
+        window.geometry("500x400")
+        window.configure(bg='#f5f5f5')
+        
+        tree = ttk.Treeview(window, columns=('files', 'size'), height=10)
+        tree.heading('#0', text="Category")
+        tree.heading('files', text="Files")
+        tree.heading('size', text="Size")
+        tree.column('files', width=80, anchor='e')
+        tree.column('size', width=100, anchor='e')
+        summary = summarize_plan(plan)
+        for category, (count, size) in sorted(summary.items()):
+            tree.insert('', tk.END, text=category, values=(count, f"{size / 1048576:.1f} MB"))
+        tree.pack(fill='both', expand=True, padx=10, pady=10)
+        
+        total_size = sum(size for _, size in summary.values())
+        text = f"{len(plan['moves'])} files, {total_size / 1048576:.1f} MB"
+        if previous is not None:
+            diff = diff_plans(previous, plan)
+            text += (f"\nSince the last preview: {len(diff['added'])} new, "
+                     f"{len(diff['removed'])} gone, {len(diff['changed'])} going elsewhere")
+        tk.Label(
+            window,
+            text=text,
+            font=("Arial", 10),
+            bg='#f5f5f5',
+            fg='#34495e'
+        ).pack(pady=5)
         
-        # Log buttons frame
-        log_btn_frame = tk.Frame(parent, bg='#f5f5f5')
-        log_btn_frame.pack(pady=10, fill='x')
+        button_frame = tk.Frame(window, bg='#f5f5f5')
+        button_frame.pack(pady=10)
         
+        def apply():
+            window.destroy()
+            self.apply_plan(plan)
+            
         tk.Button(
-            log_btn_frame,
-            text="Refresh Log",
-            command=self.refresh_log_display,
-            bg='#3498db',
+            button_frame,
+            text="Apply",
+            command=apply,
+            bg='#2ecc71',
             fg='white',
             font=("Arial", 10, "bold"),
             relief='flat',
             padx=15,
-            pady=5
+            state='normal' if plan['moves'] else 'disabled'
         ).pack(side='left', padx=5)
         
         tk.Button(
-            log_btn_frame,
-            text="Clear Log",
-            command=self.clear_log,
-            bg='#e74c3c',
-            fg='white',
-            font=("Arial", 10, "bold"),
+            button_frame,
+            text="Save Plan...",
+            command=lambda: self.save_plan(plan),
+            font=("Arial", 10),
             relief='flat',
-            padx=15,
-            pady=5
+            padx=15
         ).pack(side='left', padx=5)
         
         tk.Button(
-            log_btn_frame,
-            text="Open Log File",
-            command=self.view_log_file,
-            bg='#2ecc71',
-            fg='white',
-            font=("Arial", 10, "bold"),
+            button_frame,
+            text="Close",
+            command=window.destroy,
+            font=("Arial", 10),
             relief='flat',
-            padx=15,
-            pady=5
+            padx=15
         ).pack(side='left', padx=5)
         
-        # Refresh log display initially
-        self.refresh_log_display()
-        
-    def browse_folder(self):
-        folder_selected = filedialog.askdirectory()
-        if folder_selected:
-            self.source_path.set(folder_selected)
-            self.status.config(text="Ready to organize files")
-            
-    def organize_files(self):
-        if self.organizing:
+    def save_plan(self, plan):
+        path = filedialog.asksaveasfilename(defaultextension='.jsonl', filetypes=[("Plans", "*.jsonl")])
+        if not path:
             return
             
-        source = self.source_path.get()
-        if not source:
-            messagebox.showerror("Error", "Please select a folder first")
+        try:
+            write_plan(plan, path)
+            self.status.config(text=f"Plan saved to {path}")
+        except OSError as e:
+            messagebox.showerror("Error", f"Could not save the plan: {str(e)}")
+            
+    def apply_plan(self, plan):
+        if self.organizing:
             return
             
         self.organizing = True
         self.organize_btn.config(state='disabled', text="Organizing...")
-        self.status.config(text="Organizing files...")
-        self.root.update()
+        self.preview_btn.config(state='disabled')
+        self.undo_btn.config(state='disabled')
+        self.status.config(text="Applying the plan...")
+        self.sync_settings()
         
-        try:
-            # Get all files in the source directory
-            files = [f for f in os.listdir(source) if os.path.isfile(os.path.join(source, f))]
-            total_files = len(files)
-            
-            if total_files == 0:
-                messagebox.showinfo("Info", "No files found to organize")
-                self.organizing = False
-                self.organize_btn.config(state='normal', text="Organize Files")
-                self.status.config(text="No files found to organize")
-                return
-                
-            self.progress['maximum'] = total_files
-            moved_count = 0
-            move_operations = []
+        def done(result, error):
+            self.preview_btn.config(state='normal')
+            self.organize_done(result, error)
             
-            for i, filename in enumerate(files):
-                file_path = os.path.join(source, filename)
-                
-                # Skip if it's a directory
-                if os.path.isdir(file_path):
-                    continue
-                    
-                # Get file extension
-                _, ext = os.path.splitext(filename)
-                ext = ext.lower()
-                
-                # Find the category for this file
-                category = 'Others'
-                for cat, exts in self.categories.items():
-                    if ext in exts:
-                        category = cat
-                        break
-                
-                # Create category directory if it doesn't exist
-                category_dir = os.path.join(source, category)
-                if not os.path.exists(category_dir):
-                    os.makedirs(category_dir)
-                
-                # Move the file
-                try:
-                    dest_path = os.path.join(category_dir, filename)
-                    shutil.move(file_path, dest_path)
-                    moved_count += 1
-                    
-                    # Record the move operation for undo
-                    move_operations.append({
-                        'filename': filename,
-                        'source': source,
-                        'destination': category_dir,
-                        'timestamp': datetime.now().isoformat()
-                    })
-                    
-                    # Log the action
-                    logging.info(f"Moved: {filename} -> {category}")
-                    
-                except Exception as e:
-                    logging.error(f"Error moving {filename}: {str(e)}")
-                
-                # Update progress
-                self.progress['value'] = i + 1
-                self.status.config(text=f"Processed {i+1} of {total_files} files")
-                self.root.update()
-            
-            # Add to history if files were moved
-            if move_operations:
-                self.move_history.append({
-                    'timestamp': datetime.now().isoformat(),
-                    'source': source,
-                    'operations': move_operations,
-                    'total_moved': moved_count,
-                    'total_files': total_files
-                })
-                self.save_state()
-                self.update_history_listbox()
-                self.undo_btn.config(state='normal')
+        self.run_in_background(
+            lambda: self.engine.apply_plan(plan, progress=self.post_progress, cancel=self.cancel_event),
+            done,
+            folder=plan['source']
+        )
+        
+    def recover_interrupted(self):
+        interrupted = self.engine.wal.interrupted
+        if not interrupted:
+            return
             
-            # Show completion message
-            messagebox.showinfo("Complete", f"Organized {moved_count} of {total_files} files")
-            self.status.config(text=f"Organized {moved_count} of {total_files} files")
+        mode = self.engine.settings['recovery']
+        if mode == 'ask':
+            folders = ', '.join(sorted({run['source'] for run in interrupted}))
+            answer = messagebox.askyesnocancel(
+                "Interrupted Run",
+                f"The last session stopped part way through organizing {folders}.\n\n"
+                "Yes finishes the interrupted moves, No moves the files back where they were, "
+                "Cancel decides later."
+            )
+            if answer is None:
+                return
+            mode = 'resume' if answer else 'rollback'
             
-        except Exception as e:
-            messagebox.showerror("Error", f"An error occurred: {str(e)}")
-            logging.error(f"Organization error: {str(e)}")
-            self.status.config(text="Error occurred during organization")
+        self.organizing = True
+        self.organize_btn.config(state='disabled')
+        self.undo_btn.config(state='disabled')
+        self.status.config(text="Recovering the interrupted run...")
+        self.run_in_background(lambda: self.engine.recover(mode), self.recover_done)
+        
+    def recover_done(self, result, error):
+        self.organizing = False
+        self.organize_btn.config(state='normal')
+        self.update_history_listbox()
+        self.refresh_log_display()
+        if self.engine.move_history:
+            self.undo_btn.config(state='normal')
             
-        finally:
-            self.organizing = False
-            self.organize_btn.config(state='normal', text="Organize Files")
-            self.progress['value'] = 0
-            self.refresh_log_display()
+        if error is not None:
+            messagebox.showerror("Error", f"An error occurred during recovery: {str(error)}")
+            logging.error(f"Recovery error: {str(error)}")
+            self.status.config(text="Error occurred during recovery")
+            return
             
+        self.status.config(text=f"Recovered {result} interrupted runs")
+        
     def undo_last_organization(self):
-        if not self.move_history:
+        if self.organizing:
+            return
+            
+        if not self.engine.move_history:
             messagebox.showinfo("Info", "No organization history to undo")
             return
             
-        last_organization = self.move_history.pop()
-        operations = last_organization['operations']
-        total_operations = len(operations)
+        self.start_undo(self.engine.move_history[-1]['id'])
+        
+    def undo_selected_run(self):
+        if self.organizing:
+            return
+            
+        selection = self.history_listbox.curselection()
+        if not selection:
+            messagebox.showinfo("Info", "Select a run in the history first")
+            return
+        # The "Loading history..." row stands for no run
+        if selection[0] >= len(self.history_rows):
+            return
+            
+        run = self.engine.history_run(self.history_rows[selection[0]])
+        if run is None:
+            return
+            
+        categories = sorted({os.path.basename(operation['destination'])
+                             for operation in self.engine.run_operations(run)})
+        
+        window = tk.Toplevel(self.root)
+        window.title("Undo Run")
+        window.configure(bg='#f5f5f5')
+        
+        timestamp = datetime.fromisoformat(run['timestamp']).strftime("%Y-%m-%d %H:%M")
+        tk.Label(
+            window,
+            text=f"{timestamp}: {run['total_moved']} files in {run['source']}\n"
+                 "Restore only these categories (none selected means all):",
+            font=("Arial", 10),
+            bg='#f5f5f5',
+            fg='#34495e',
+            justify='left'
+        ).pack(anchor='w', padx=10, pady=5)
+        
+        category_list = tk.Listbox(window, selectmode=tk.MULTIPLE, height=min(10, len(categories)), font=("Arial", 9))
+        for category in categories:
+            category_list.insert(tk.END, category)
+        category_list.pack(fill='x', padx=10)
+        
+        pattern = tk.StringVar()
+        pattern_frame = tk.Frame(window, bg='#f5f5f5')
+        pattern_frame.pack(fill='x', padx=10, pady=5)
+        
+        tk.Label(
+            pattern_frame,
+            text="Only files matching:",
+            font=("Arial", 10),
+            bg='#f5f5f5',
+            fg='#34495e'
+        ).pack(side='left')
+        
+        tk.Entry(pattern_frame, textvariable=pattern, font=("Arial", 10)).pack(side='left', fill='x', expand=True, padx=5)
+        
+        def undo():
+            chosen = [categories[i] for i in category_list.curselection()] or None
+            window.destroy()
+            self.start_undo(run['id'], chosen, pattern.get().strip() or None)
+            
+        tk.Button(
+            window,
+            text="Undo",
+            command=undo,
+            bg='#e74c3c',
+            fg='white',
+            font=("Arial", 10, "bold"),
+            relief='flat',
+            padx=15
+        ).pack(pady=10)
         
-        self.progress['maximum'] = total_operations
+    # Checks the whole undo in the background first, so conflicts are
+    # reported before any file is moved
+    def start_undo(self, run_id, categories=None, pattern=None):
+        self.organizing = True
+        self.organize_btn.config(state='disabled')
+        self.undo_btn.config(state='disabled')
         self.progress['value'] = 0
-        self.status.config(text="Undoing last organization...")
-        self.root.update()
+        self.status.config(text="Checking the files to restore...")
+        self.sync_settings()
         
-        restored_count = 0
+        run = self.engine.history_run(run_id)
+        self.run_in_background(
+            lambda: self.engine.check_undo(run, categories, pattern),
+            lambda check, error: self.undo_checked(run_id, categories, pattern, check, error)
+        )
         
-        for i, operation in enumerate(operations):
-            try:
-                source_file = os.path.join(operation['destination'], operation['filename'])
-                dest_path = os.path.join(operation['source'], operation['filename'])
-                
-                if os.path.exists(source_file):
-                    shutil.move(source_file, dest_path)
-                    restored_count += 1
-                    logging.info(f"Undo: Moved {operation['filename']} back to original location")
-                
-            except Exception as e:
-                logging.error(f"Error during undo for {operation['filename']}: {str(e)}")
+    def undo_checked(self, run_id, categories, pattern, check, error):
+        if error is not None:
+            self.undo_done(None, error)
+            return
             
-            self.progress['value'] = i + 1
-            self.root.update()
+        if check['conflicts'] or check['missing']:
+            proceed = messagebox.askyesno(
+                "Undo",
+                f"{len(check['conflicts'])} files can't be restored because their names are taken again, "
+                f"and {len(check['missing'])} are no longer where they were moved to.\n\n"
+                f"Restore the other {len(check['restore'])} files?"
+            )
+            if not proceed:
+                self.undo_done(None, None)
+                return
+                
+        self.status.config(text="Undoing...")
+        self.run_in_background(
+            lambda: self.engine.undo_run(run_id, categories, pattern, progress=self.post_progress,
+                                         cancel=self.cancel_event),
+            self.undo_done
+        )
+        
+    def undo_done(self, result, error):
+        self.organizing = False
+        self.organize_btn.config(state='normal')
+        self.progress['value'] = 0
         
         # Update UI
-        self.save_state()
         self.update_history_listbox()
         self.refresh_log_display()
         
-        if not self.move_history:
-            self.undo_btn.config(state='disabled')
+        if self.engine.move_history:
+            self.undo_btn.config(state='normal')
+            
+        if error is not None:
+            messagebox.showerror("Error", f"An error occurred during undo: {str(error)}")
+            logging.error(f"Undo error: {str(error)}")
+            self.status.config(text="Error occurred during undo")
+            return
+            
+        if result is None:
+            self.status.config(text="Undo cancelled")
+            return
             
+        restored_count, total_operations = result
         messagebox.showinfo("Undo Complete", f"Restored {restored_count} of {total_operations} files")
         self.status.config(text=f"Undo complete: {restored_count} files restored")
-        self.progress['value'] = 0
         
     def start_scheduler(self):
         minutes = self.schedule_minutes.get()
@@ -566,23 +4523,50 @@ class FileOrganizer:
         self.scheduler_running = True
         self.start_scheduler_btn.config(state='disabled')
         self.stop_scheduler_btn.config(state='normal')
-        self.scheduler_status.config(text=f"Scheduler running every {minutes} minutes", fg='#2ecc71')
+        # Both the watcher and the scheduler run with the settings on screen
+        self.sync_settings()
         
-        # Clear any existing schedule
-        schedule.clear()
-        
-        # Schedule the task
-        schedule.every(minutes).minutes.do(self.scheduled_organization)
+        if self.watch_mode.get():
+            self.scheduler_status.config(text="Watching folder for new files", fg='#2ecc71')
+            # A new event per session: a watcher that was stopped but hasn't
+            # noticed yet must not be started again by this one
+            self.watch_stop = threading.Event()
+            self.scheduler_thread = threading.Thread(
+                target=self.watch_loop,
+                args=(self.source_path.get(), self.watch_stop),
+                daemon=True
+            )
+            self.scheduler_thread.start()
+            self.refresh_log_display()
+            return
+            
+        self.folder_scheduler = FolderScheduler(
+            self.engine,
+            max_backoff=self.engine.settings['max_backoff'],
+            on_start=self.scheduled_started,
+            on_done=self.scheduled_done
+        )
+        self.folder_scheduler.add_folder(self.source_path.get(), minutes)
+        for folder in self.engine.settings['folders']:
+            self.folder_scheduler.add_folder(folder['path'], folder.get('minutes', minutes), folder.get('rules_file'),
+                                             folder.get('limits'))
+        self.folder_scheduler.start()
         
-        # Start the scheduler in a separate thread
-        self.scheduler_thread = threading.Thread(target=self.scheduler_loop, daemon=True)
-        self.scheduler_thread.start()
+        folder_count = len(self.folder_scheduler.folders)
+        if folder_count > 1:
+            self.scheduler_status.config(text=f"Scheduler running for {folder_count} folders", fg='#2ecc71')
+        else:
+            self.scheduler_status.config(text=f"Scheduler running every {minutes} minutes", fg='#2ecc71')
         
         logging.info(f"Scheduler started. Will run every {minutes} minutes.")
         self.refresh_log_display()
         
     def stop_scheduler(self):
         self.scheduler_running = False
+        self.watch_stop.set()
+        if self.folder_scheduler:
+            self.folder_scheduler.stop()
+            self.folder_scheduler = None
         self.start_scheduler_btn.config(state='normal')
         self.stop_scheduler_btn.config(state='disabled')
         self.scheduler_status.config(text="Scheduler is not running", fg='#e74c3c')
@@ -590,160 +4574,226 @@ class FileOrganizer:
         logging.info("Scheduler stopped.")
         self.refresh_log_display()
         
-    def scheduler_loop(self):
-        while self.scheduler_running:
-            schedule.run_pending()
-            time.sleep(1)
-            
-    def scheduled_organization(self):
-        # This method runs on the scheduler thread
-        logging.info("Scheduled organization started")
-        
-        # Use after() to schedule UI updates on the main thread
-        self.root.after(0, lambda: self.status.config(text="Running scheduled organization..."))
-        self.root.after(0, lambda: self.organize_btn.config(state='disabled', text="Organizing..."))
-        
+    def watch_loop(self, source, stop):
+        # This method runs on the watcher thread
         try:
-            source = self.source_path.get()
-            files = [f for f in os.listdir(source) if os.path.isfile(os.path.join(source, f))]
-            total_files = len(files)
+            self.engine.watch(source, stop, on_batch=self.watch_batch_done)
+        except Exception as e:
+            logging.error(f"Error in folder watcher: {str(e)}")
+            # A stopped session's watcher leaves the current one alone
+            if not stop.is_set():
+                self.on_tk_thread(self.stop_scheduler)
             
-            if total_files == 0:
-                logging.info("Scheduled organization: No files to organize")
-                return
-                
-            moved_count = 0
-            move_operations = []
+    def watch_batch_done(self, result):
+        moved_count, total_files = result
+        if moved_count:
+            # Update UI on main thread
+            self.on_tk_thread(self.update_history_listbox)
+            self.on_tk_thread(lambda: self.undo_btn.config(state='normal'))
+            self.on_tk_thread(lambda: self.status.config(text=f"Watcher moved {moved_count} new files"))
+            self.on_tk_thread(self.refresh_log_display)
             
-            for filename in files:
-                file_path = os.path.join(source, filename)
-                
-                if os.path.isdir(file_path):
-                    continue
-                    
-                _, ext = os.path.splitext(filename)
-                ext = ext.lower()
-                
-                category = 'Others'
-                for cat, exts in self.categories.items():
-                    if ext in exts:
-                        category = cat
-                        break
-                
-                category_dir = os.path.join(source, category)
-                if not os.path.exists(category_dir):
-                    os.makedirs(category_dir)
-                
-                try:
-                    dest_path = os.path.join(category_dir, filename)
-                    shutil.move(file_path, dest_path)
-                    moved_count += 1
-                    
-                    move_operations.append({
-                        'filename': filename,
-                        'source': source,
-                        'destination': category_dir,
-                        'timestamp': datetime.now().isoformat()
-                    })
-                    
-                    logging.info(f"Scheduled move: {filename} -> {category}")
-                    
-                except Exception as e:
-                    logging.error(f"Error in scheduled move for {filename}: {str(e)}")
-            
-            if move_operations:
-                self.move_history.append({
-                    'timestamp': datetime.now().isoformat(),
-                    'source': source,
-                    'operations': move_operations,
-                    'total_moved': moved_count,
-                    'total_files': total_files
-                })
-                self.save_state()
-                
-                # Update UI on main thread
-                self.root.after(0, self.update_history_listbox)
-                self.root.after(0, lambda: self.undo_btn.config(state='normal'))
-                
-            logging.info(f"Scheduled organization complete: {moved_count} files moved")
+    def scheduled_started(self, path):
+        # This method runs on a scheduler worker thread
+        self.on_tk_thread(lambda: self.status.config(text=f"Running scheduled organization of {path}..."))
+        
+    def scheduled_done(self, path, result, error):
+        # This method runs on a scheduler worker thread
+        moved_count = result[0] if result else 0
+        if moved_count:
+            # Update UI on main thread
+            self.on_tk_thread(self.update_history_listbox)
+            self.on_tk_thread(lambda: self.undo_btn.config(state='normal'))
             
-        except Exception as e:
-            logging.error(f"Error in scheduled organization: {str(e)}")
+        self.on_tk_thread(lambda: self.status.config(
+            text=f"Scheduled organization complete: {moved_count} files moved in {path}"
+        ))
+        self.on_tk_thread(self.refresh_log_display)
+        
+    def update_folders_listbox(self):
+        self.folders_listbox.delete(0, tk.END)
+        for folder in self.engine.settings['folders']:
+            minutes = folder.get('minutes', self.schedule_minutes.get())
+            text = f"{folder['path']} (every {minutes} min)"
+            if folder.get('rules_file'):
+                text += f", rules: {folder['rules_file']}"
+            self.folders_listbox.insert(tk.END, text)
             
-        finally:
-            # Update UI on main thread
-            self.root.after(0, lambda: self.organize_btn.config(state='normal', text="Organize Files"))
-            self.root.after(0, lambda: self.status.config(
-                text=f"Scheduled organization complete: {moved_count} files moved"
-            ))
-            self.root.after(0, self.refresh_log_display)
+    def add_scheduled_folder(self):
+        folder = filedialog.askdirectory()
+        if not folder:
+            return
+            
+        # New folders start on the interval in the minutes box; edit the
+        # state file to give one a different interval or rules file
+        self.engine.settings['folders'].append({'path': folder, 'minutes': self.schedule_minutes.get()})
+        self.update_folders_listbox()
+        self.save_state()
+        
+    def remove_scheduled_folder(self):
+        selection = self.folders_listbox.curselection()
+        if not selection:
+            return
             
+        del self.engine.settings['folders'][selection[0]]
+        self.update_folders_listbox()
+        self.save_state()
+        
+    # The history is read on a worker thread after the window is up, so a
+    # long history doesn't hold up the start
+    def load_history(self):
+        self.engine.jobs.submit(
+            self.engine.load_history,
+            on_done=lambda result, error: self.on_tk_thread(lambda: self.history_ready(error))
+        )
+        
+    def history_ready(self, error):
+        if error is not None:
+            logging.error(f"Error loading history: {str(error)}")
+        self.update_history_listbox()
+        if self.engine.move_history and not self.organizing:
+            self.undo_btn.config(state='normal')
+        
     def update_history_listbox(self):
-        self.history_listbox.delete(0, tk.END)
+        # A new run lands on the first page
+        self.show_history_page(0)
         
-        for i, history in enumerate(reversed(self.move_history)):
+    # Shows HISTORY_PAGE runs, page 0 being the newest; only those rows are
+    # formatted
+    def show_history_page(self, page):
+        runs = self.engine.move_history
+        pages = max(1, -(-len(runs) // HISTORY_PAGE))
+        self.history_page = page = min(max(0, page), pages - 1)
+        
+        end = len(runs) - page * HISTORY_PAGE
+        self.history_listbox.delete(0, tk.END)
+        self.history_rows = []
+        for history in runs[max(0, end - HISTORY_PAGE):end]:
+            self.history_rows.append(history['id'])
             timestamp = datetime.fromisoformat(history['timestamp']).strftime("%Y-%m-%d %H:%M")
-            self.history_listbox.insert(0, f"{timestamp}: {history['total_moved']} files moved in {history['source']}")
+            text = f"{timestamp}: {history['total_moved']} files moved in {history['source']}"
+            if 'metrics' in history:
+                text += f" ({describe_metrics(history['metrics'])})"
+            self.history_listbox.insert(tk.END, text)
+        self.history_position.config(text=f"Page {page + 1} of {pages} ({len(runs)} runs)")
             
+    # Appends whatever was logged since the last call. Only the bytes added
+    # since then are read, and the widget keeps the newest LOG_VIEW_LINES.
     def refresh_log_display(self):
+        flush_logs()
+        reset, new_lines = self.log_tail.read_new()
+        if self.log_page is not None:
+            # Showing an older page or search results; the new lines are
+            # picked up by "Latest"
+            return
+            
+        if reset:
+            self.show_log_lines(self.log_tail.lines)
+            return
+            
+        if new_lines:
+            self.log_text.config(state='normal')
+            self.log_text.insert(tk.END, ''.join(new_lines))
+            excess = int(self.log_text.index('end-1c').split('.')[0]) - LOG_VIEW_LINES
+            if excess > 0:
+                self.log_text.delete('1.0', f'{excess + 1}.0')
+            self.log_text.config(state='disabled')
+            self.log_text.see(tk.END)
+            
+    def show_log_lines(self, lines, position=""):
         self.log_text.config(state='normal')
         self.log_text.delete(1.0, tk.END)
-        
-        if os.path.exists('organizer_log.txt'):
-            with open('organizer_log.txt', 'r') as f:
-                log_content = f.read()
-                self.log_text.insert(tk.END, log_content)
-        
+        self.log_text.insert(tk.END, ''.join(lines))
         self.log_text.config(state='disabled')
         self.log_text.see(tk.END)
+        self.log_position.config(text=position)
+        
+    def show_log_page(self, page):
+        self.log_page = page
+        self.show_log_lines(self.log_tail.read_page(page), f"Page {page + 1} of {len(self.log_tail.pages)}")
+        self.log_text.see('1.0')
+        
+    def older_log_page(self):
+        self.log_tail.read_new()
+        if not self.log_tail.pages:
+            return
+        if self.log_page is None or self.log_page == 'search':
+            # Start from the first page not already on screen
+            shown_pages = -(-len(self.log_tail.lines) // LOG_PAGE_LINES)
+            page = len(self.log_tail.pages) - 1 - shown_pages
+        else:
+            page = self.log_page - 1
+        self.show_log_page(max(0, page))
+        
+    def newer_log_page(self):
+        if self.log_page is None or self.log_page == 'search':
+            return
+        if self.log_page + 1 >= len(self.log_tail.pages):
+            self.latest_log()
+        else:
+            self.show_log_page(self.log_page + 1)
+            
+    def latest_log(self):
+        self.log_page = None
+        self.log_filter.set("")
+        self.log_tail.read_new()
+        self.show_log_lines(self.log_tail.lines)
+        
+    def search_log(self):
+        text = self.log_filter.get().strip()
+        if not text:
+            self.latest_log()
+            return
+            
+        flush_logs()
+        self.log_tail.read_new()
+        matches = self.log_tail.search(text)
+        self.log_page = 'search'
+        self.show_log_lines(matches, f"{len(matches)} matching lines")
         
     def clear_log(self):
         try:
-            with open('organizer_log.txt', 'w') as f:
+            flush_logs()
+            with open(LOG_FILE, 'w') as f:
                 f.write("")
+            self.log_page = None
             self.refresh_log_display()
             logging.info("Log file cleared by user")
         except Exception as e:
             messagebox.showerror("Error", f"Could not clear log file: {str(e)}")
             
     def view_log_file(self):
-        if os.path.exists('organizer_log.txt'):
-            os.startfile('organizer_log.txt')
+        if os.path.exists(LOG_FILE):
+            os.startfile(LOG_FILE)
         else:
             messagebox.showinfo("Info", "No log file found yet.")
             
-    def save_state(self):
-        state = {
-            'source_path': self.source_path.get(),
-            'move_history': self.move_history,
-            'schedule_minutes': self.schedule_minutes.get()
-        }
+    def sync_settings(self):
+        self.engine.settings['source_path'] = self.source_path.get()
+        self.engine.settings['schedule_minutes'] = self.schedule_minutes.get()
+        self.engine.settings['watch_mode'] = self.watch_mode.get()
+        self.engine.settings['dedupe'] = self.dedupe_mode.get()
+        self.engine.settings['sniff'] = self.sniff_mode.get()
+        self.engine.settings['conflicts'] = self.conflict_mode.get()
+        self.engine.settings['log_detail'] = self.log_detail.get()
+        self.engine.settings['recursive'] = self.recursive.get()
         
-        with open('organizer_state.json', 'w') as f:
-            json.dump(state, f)
+    def save_state(self):
+        self.sync_settings()
+        self.engine.save_state()
             
     def load_state(self):
-        try:
-            if os.path.exists('organizer_state.json'):
-                with open('organizer_state.json', 'r') as f:
-                    state = json.load(f)
-                    
-                self.source_path.set(state.get('source_path', ''))
-                self.move_history = state.get('move_history', [])
-                self.schedule_minutes.set(state.get('schedule_minutes', 5))
-                
-        except Exception as e:
-            print(f"Error loading state: {str(e)}")
+        self.engine.load_state()
+        self.source_path.set(self.engine.settings['source_path'])
+        self.schedule_minutes.set(self.engine.settings['schedule_minutes'])
+        self.watch_mode.set(self.engine.settings['watch_mode'])
+        self.dedupe_mode.set(self.engine.settings['dedupe'])
+        self.sniff_mode.set(self.engine.settings['sniff'])
+        self.conflict_mode.set(self.engine.settings['conflicts'])
+        self.log_detail.set(self.engine.settings['log_detail'])
+        self.recursive.set(self.engine.settings['recursive'])
             
     def run(self):
-        # Set up logging
-        logging.basicConfig(
-            filename='organizer_log.txt',
-            level=logging.INFO,
-            format='%(asctime)s - %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
-        
         logging.info("File Organizer started")
         
         # Start the application
@@ -753,9 +4803,231 @@ class FileOrganizer:
     def on_closing(self):
         self.stop_scheduler()
         self.save_state()
+        self.engine.close()
         self.root.destroy()
 
+def run_headless(args):
+    logging.info("File Organizer started (headless)")
+
+    engine = OrganizerEngine(rules_file=args.rules)
+    engine.load_state()
+    try:
+        if engine.wal.interrupted:
+            mode = args.recover or engine.settings['recovery']
+            if mode == 'ask':
+                mode = 'resume'
+            recovered = engine.recover(mode)
+            print(f"Recovered {recovered} interrupted runs ({mode})")
+        return run_headless_command(engine, args)
+    finally:
+        engine.close()
+
+
+def run_headless_command(engine, args):
+    if args.undo or args.undo_run is not None:
+        run_id = args.undo_run
+        if run_id is None and engine.move_history:
+            run_id = engine.move_history[-1]['id']
+        run = engine.history_run(run_id)
+        if run is None:
+            print("No organization history to undo")
+            return 1
+
+        # Report conflicts before anything moves
+        check = engine.check_undo(run, args.category, args.pattern)
+        for operation in check['conflicts']:
+            print(f"Conflict: {os.path.join(operation['source'], operation['filename'])} exists")
+        if check['missing']:
+            print(f"{len(check['missing'])} files are no longer where they were moved to")
+        if check['conflicts'] and not args.skip_conflicts:
+            print("Nothing was moved; use --skip-conflicts to restore the other files", file=sys.stderr)
+            return 1
+
+        restored_count, total_operations = engine.undo_run(run_id, args.category, args.pattern)
+        print(f"Restored {restored_count} of {total_operations} files")
+        return 0
+
+    if args.diff:
+        diff = diff_plans(load_plan(args.diff[0]), load_plan(args.diff[1]))
+        for kind, sign in (('added', '+'), ('removed', '-'), ('changed', '~')):
+            for path in diff[kind]:
+                print(f"{sign} {path}")
+        return 0
+
+    if args.apply:
+        plan = load_plan(args.apply)
+        moved_count, total_files = engine.apply_plan(plan)
+        print(f"Applied plan: organized {moved_count} of {total_files} files "
+              f"({describe_metrics(engine.last_metrics.summary())})")
+        return 0
+
+    source = args.source or engine.settings['source_path']
+    if not source or not os.path.isdir(source):
+        print(f"Error: source folder not found: {source}", file=sys.stderr)
+        return 1
+
+    engine.settings['source_path'] = source
+    if args.workers:
+        engine.settings['move_workers'] = args.workers
+    if args.dedupe:
+        engine.settings['dedupe'] = args.dedupe
+    if args.sniff:
+        engine.settings['sniff'] = args.sniff
+    if args.conflicts:
+        engine.settings['conflicts'] = args.conflicts
+    if args.log_detail:
+        engine.settings['log_detail'] = args.log_detail
+    if args.verify:
+        engine.settings['verify_copies'] = True
+    if args.quiet_seconds is not None:
+        engine.settings['quiet_seconds'] = args.quiet_seconds
+    if args.check_open_files:
+        engine.settings['check_open_files'] = True
+    if args.max_moves:
+        engine.settings['max_moves_per_sec'] = args.max_moves
+    if args.max_bytes:
+        engine.settings['max_bytes_per_sec'] = args.max_bytes
+    if args.max_io_pressure is not None:
+        engine.settings['max_io_pressure'] = args.max_io_pressure
+    if args.nice is not None:
+        engine.settings['nice'] = args.nice
+    if args.io_priority:
+        engine.settings['io_priority'] = args.io_priority
+    if args.recursive:
+        engine.settings['recursive'] = True
+    if args.include:
+        engine.settings['include_dirs'] = args.include
+    if args.exclude:
+        engine.settings['exclude_dirs'] = args.exclude
+    if args.scan_workers:
+        engine.settings['scan_workers'] = args.scan_workers
+    if args.metrics_file:
+        engine.settings['metrics_file'] = args.metrics_file
+
+    if args.watch:
+        def batch_done(result):
+            moved_count, total_files = result
+            if total_files:
+                print(f"Organized {moved_count} of {total_files} files")
+
+        print(f"Watching {source} for new files, press Ctrl+C to stop")
+        try:
+            engine.watch(source, threading.Event(), on_batch=batch_done)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.plan:
+        plan = engine.plan(source)
+        write_plan(plan, args.plan)
+        for category, (count, size) in sorted(summarize_plan(plan).items()):
+            print(f"{category:<15} {count:>8} files {size / 1048576:>10.1f} MB")
+        print(f"Wrote a plan for {len(plan['moves'])} moves to {args.plan}")
+        return 0
+
+    if args.schedule:
+        def folder_done(path, result, error):
+            if result and result[1]:
+                print(f"Organized {result[0]} of {result[1]} files in {path}")
+
+        scheduler = FolderScheduler(engine, engine.settings['max_backoff'], on_done=folder_done)
+        scheduler.add_folder(source, engine.settings['schedule_minutes'])
+        for folder in engine.settings['folders']:
+            scheduler.add_folder(folder['path'], folder.get('minutes', engine.settings['schedule_minutes']),
+                                 folder.get('rules_file'), folder.get('limits'))
+        print(f"Organizing {len(scheduler.folders)} folders on a schedule, press Ctrl+C to stop")
+        scheduler.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        scheduler.stop()
+        return 0
+
+    moved_count, total_files = engine.organize(source)
+    if total_files == 0:
+        print("No files found to organize")
+    else:
+        print(f"Organized {moved_count} of {total_files} files ({describe_metrics(engine.last_metrics.summary())})")
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Organize files into category folders")
+    parser.add_argument('--headless', action='store_true',
+                        help="run once without the GUI and exit")
+    parser.add_argument('--source', help="folder to organize (defaults to the saved folder)")
+    parser.add_argument('--undo', action='store_true',
+                        help="with --headless, undo the last organization instead")
+    parser.add_argument('--undo-run', type=int, metavar='ID',
+                        help="with --headless, undo the run with this id from the history")
+    parser.add_argument('--category', action='append',
+                        help="with --undo or --undo-run, only restore files from this category (repeatable)")
+    parser.add_argument('--pattern',
+                        help="with --undo or --undo-run, only restore files matching this glob")
+    parser.add_argument('--skip-conflicts', action='store_true',
+                        help="undo even if some original names are taken, leaving those files in place")
+    parser.add_argument('--watch', action='store_true',
+                        help="with --headless, keep running and organize new files as they arrive")
+    parser.add_argument('--plan', metavar='FILE',
+                        help="with --headless, write what would be moved to FILE without moving anything")
+    parser.add_argument('--apply', metavar='FILE',
+                        help="with --headless, carry out a plan written by --plan")
+    parser.add_argument('--diff', nargs=2, metavar=('OLD', 'NEW'),
+                        help="with --headless, show how two plans differ")
+    parser.add_argument('--recover', choices=['resume', 'rollback'],
+                        help="how to deal with runs cut short by a crash (defaults to the recovery setting)")
+    parser.add_argument('--schedule', action='store_true',
+                        help="with --headless, keep running and organize the saved folders on their intervals")
+    parser.add_argument('--dedupe', choices=['off', 'report', 'move'],
+                        help="find files with identical contents and log them, or move them to Duplicates")
+    parser.add_argument('--sniff', choices=['off', 'fill', 'override'],
+                        help="check file contents for files with unknown (fill) or any (override) extension")
+    parser.add_argument('--conflicts', choices=['skip', 'rename', 'rename-hash', 'overwrite-newer', 'dedupe'],
+                        help="what to do when a category folder already has a file of the same name")
+    parser.add_argument('--log-detail', choices=['files', 'summary'],
+                        help="log every moved file, or one line per run with counts per category")
+    parser.add_argument('--recursive', action='store_true',
+                        help="organize files in subfolders too")
+    parser.add_argument('--include', action='append', metavar='PATTERN',
+                        help="with --recursive, only organize subfolders matching this (repeatable)")
+    parser.add_argument('--exclude', action='append', metavar='PATTERN',
+                        help="with --recursive, skip subfolders matching this (repeatable)")
+    parser.add_argument('--scan-workers', type=int,
+                        help="threads reading subfolders in a recursive run")
+    parser.add_argument('--max-moves', type=float, metavar='N',
+                        help="move at most N files a second")
+    parser.add_argument('--max-bytes', type=float, metavar='N',
+                        help="copy at most N bytes a second to other filesystems")
+    parser.add_argument('--max-io-pressure', type=float, metavar='PERCENT',
+                        help="pause while the disk pressure (/proc/pressure/io avg10) is above this")
+    parser.add_argument('--nice', type=int, help="run moves at this CPU niceness")
+    parser.add_argument('--io-priority', choices=['low', 'idle'], help="run moves at a lower I/O priority")
+    parser.add_argument('--quiet-seconds', type=float, metavar='N',
+                        help="only move files that haven't changed for N seconds")
+    parser.add_argument('--check-open-files', action='store_true',
+                        help="leave files that a process has open for writing")
+    parser.add_argument('--verify', action='store_true',
+                        help="check copies to another filesystem against a hash taken while copying")
+    parser.add_argument('--metrics-file',
+                        help="write Prometheus metrics to this file after every run")
+    parser.add_argument('--workers', type=int,
+                        help="threads used for moves that have to copy across devices")
+    parser.add_argument('--rules', default=RULES_FILE,
+                        help="JSON file with extra categories and rules (default: %(default)s)")
+    return parser.parse_args(argv)
+
+
 # Run the application
 if __name__ == "__main__":
-    app = FileOrganizer()
-    app.run()
\ No newline at end of file
+    args = parse_args()
+
+    # Set up logging before the engine loads its rules
+    setup_logging()
+
+    if args.headless:
+        sys.exit(run_headless(args))
+
+    app = FileOrganizer(OrganizerEngine(rules_file=args.rules))
+    app.run()